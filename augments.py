@@ -2,10 +2,10 @@
 # Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
 
 from __future__ import division, print_function
-from functools import partial,wraps
+from functools import partial,wraps,lru_cache
 import numpy as np
 import scipy.ndimage
-import scipy.fftpack as ft
+from scipy import fft as ft
 
 import trainutils
         
@@ -15,30 +15,71 @@ try:
 except ImportError:
     pilAvailable=False
     
+try:
+    import cv2
+    cvAvailable=True
+except ImportError:
+    cvAvailable=False
+    
+# array types OpenCV's geometric transforms accept, anything else is converted to float32 first
+cvTypes=tuple(map(np.dtype,(np.uint8,np.uint16,np.int16,np.float32,np.float64)))
+
 
-def augment(prob=0.5,applyIndices=None):
+def augment(prob=0.5,applyIndices=None,batched=False,outArg=False):
     '''
     Creates an augmentation function when applied to a function returning an array modifying callable. The function this
     is applied to is given the list of input arrays as positional arguments and then should return a callable operation
     which performs the augmentation. This wrapper then chooses whether to apply the operation to the arguments and if so
     to which ones. The `prob' argument states the probability the augment is applied, and `applyIndices' gives indices of
     the arrays to apply to (or None for all). The arguments are also keyword arguments in the resulting augment function.
+    
+    If `batched' is True the function must also accept a `batch' keyword argument which when True indicates the arrays 
+    have a leading batch dimension, the returned operation must then augment each batch item independently. When called
+    with batch=True the probability is applied per batch item and the operation is applied only to the chosen items. The
+    resulting augment function has a `batched' attribute set to this value.
+    
+    If `outArg' is True the returned operation must accept an `out' keyword argument which is either None or an array 
+    to store the result into, which is then returned. This is used by datasource.compileAugments to write the final 
+    augment of a pipeline directly into the batch arrays. The resulting augment has an `outArg' attribute set to this.
     '''
     def _inner(func):
         @wraps(func)
         def _func(*args,**kwargs):
             _prob=kwargs.pop('prob',prob)
+            _applyIndices=kwargs.pop('applyIndices',applyIndices)
             
-            if _prob<1.0 and not trainutils.randChoice(_prob):
+            if batched and kwargs.get('batch',False) and _prob<1.0:
+                selected=np.random.random(args[0].shape[0])<=_prob
+                
+                if not selected.any():
+                    return args
+                elif not selected.all():
+                    subargs=tuple(a[selected] for a in args)
+                    subouts=_func(*subargs,prob=1.0,applyIndices=_applyIndices,**kwargs)
+                    outs=[]
+                    
+                    for a,sa,so in zip(args,subargs,subouts):
+                        if so is not sa: # only copy arrays which were actually augmented
+                            a=a.copy()
+                            a[selected]=so
+                            
+                        outs.append(a)
+                    
+                    return tuple(outs)
+            elif _prob<1.0 and not trainutils.randChoice(_prob):
                 return args
             
-            _applyIndices=kwargs.pop('applyIndices',applyIndices)
-            
             op=func(*args,**kwargs)
             indices=list(_applyIndices or range(len(args)))
             
             return tuple((op(im) if i in indices else im) for i,im in enumerate(args))
         
+        _func.batched=batched
+        _func.outArg=outArg
+        _func.augmentFunc=func # used by datasource.compileAugments to bypass this wrapper
+        _func.prob=prob
+        _func.applyIndices=applyIndices
+        
         if _func.__doc__:
             _func.__doc__+='''
        
@@ -51,6 +92,58 @@ Added keyword arguments:
     return _inner
 
 
+def cvTransform(im,func):
+    '''
+    Apply the OpenCV operation `func' to the 2D or HxWxC array `im', returning an array of the same dtype. Types OpenCV
+    doesn't support are converted to float32 and back, and arrays with more than 4 channels are done per-channel. The
+    trailing channel dimension which OpenCV drops for single-channel images is restored.
+    '''
+    if im.dtype not in cvTypes:
+        return cvTransform(im.astype(np.float32),func).astype(im.dtype)
+    elif im.ndim==3 and im.shape[2]>4:
+        return np.dstack([cvTransform(im[...,i],func) for i in range(im.shape[2])])
+    else:
+        result=func(np.ascontiguousarray(im))
+        return result.reshape(result.shape[:2]+im.shape[2:])
+
+
+@lru_cache(maxsize=None)
+def gridIndices(h,w):
+    '''Returns the (column,row) index grids of shape (h,w), these are cached so must not be modified.'''
+    y,x=np.meshgrid(np.arange(w,dtype=np.int32),np.arange(h,dtype=np.int32))
+    y.flags.writeable=x.flags.writeable=False
+    return y,x
+
+
+@lru_cache(maxsize=None)
+def centerDistanceField(h,w):
+    '''Returns the (h,w) field of distances from the center with edge midpoints at 1, cached so must not be modified.'''
+    y,x=np.meshgrid(np.linspace(-1,1,h),np.linspace(-1,1,w),indexing='ij')
+    field=np.sqrt(x**2+y**2)
+    field.flags.writeable=False
+    return field
+
+
+def cvOrNumpy(im,cvFunc,npFunc):
+    '''
+    Apply the OpenCV operation `cvFunc' to `im' if it's a 2D or HxWxC array of a type OpenCV supports, restoring any 
+    trailing channel dimension OpenCV drops, otherwise apply the equivalent Numpy operation `npFunc'.
+    '''
+    if cvAvailable and im.ndim<=3 and im.dtype in cvTypes:
+        result=cvFunc(np.ascontiguousarray(im))
+        return result.reshape(result.shape[:2]+im.shape[2:])
+    else:
+        return npFunc(im)
+
+
+def randZoomFactors(zoomrange):
+    '''Returns random zoom factors for axes 0 and 1 which are close to each other and within `zoomrange' of 1.'''
+    z=zoomrange-trainutils.randomBuffer.random()*zoomrange*2
+    zx=z+1.0+zoomrange*0.25-trainutils.randomBuffer.random()*zoomrange*0.5
+    zy=z+1.0+zoomrange*0.25-trainutils.randomBuffer.random()*zoomrange*0.5
+    return zx,zy
+
+
 def checkSegmentMargin(func):
     '''
     Decorate an augment callable `func` with a check to ensure a given segmentation image in the set does not
@@ -84,43 +177,168 @@ def checkSegmentMargin(func):
     return _check
             
 
-@augment()
-def transpose(*arrs):
+@augment(batched=True)
+def transpose(*arrs,batch=False):
     '''Transpose axes 0 and 1 for each of `arrs'.'''
-    return partial(np.swapaxes,axis1=0,axis2=1)
+    axis=1 if batch else 0
+    return partial(np.swapaxes,axis1=axis,axis2=axis+1)
 
 
-@augment()
-def flip(*arrs):
+@augment(batched=True)
+def flip(*arrs,batch=False):
     '''Flip each of `arrs' with a random choice of up-down or left-right.'''
-    return np.fliplr if trainutils.randChoice() else np.flipud
+    if not batch:
+        if trainutils.randChoice():
+            return partial(cvOrNumpy,cvFunc=lambda im:cv2.flip(im,1),npFunc=np.fliplr)
+        else:
+            return partial(cvOrNumpy,cvFunc=lambda im:cv2.flip(im,0),npFunc=np.flipud)
+    
+    lr=np.random.random(arrs[0].shape[0])<=0.5
+    
+    def _flip(arr):
+        out=np.empty_like(arr)
+        out[lr]=arr[lr,:,::-1]
+        out[~lr]=arr[~lr,::-1]
+        return out
+    
+    return _flip
 
 
-@augment()
-def rot90(*arrs):
+@augment(batched=True)
+def rot90(*arrs,batch=False):
     '''Rotate each of `arrs' a random choice of quarter, half, or three-quarter circle rotations.'''
-    return partial(np.rot90,k=np.random.randint(1,3))
+    if not batch:
+        k=trainutils.randomBuffer.randint(1,3)
+        cvFunc=lambda im:cv2.rotate(im,cv2.ROTATE_90_COUNTERCLOCKWISE if k==1 else cv2.ROTATE_180) # same as np.rot90
+        return partial(cvOrNumpy,cvFunc=cvFunc,npFunc=partial(np.rot90,k=k))
+    
+    quarter=np.random.randint(1,3,arrs[0].shape[0])==1
+    
+    def _rot90(arr):
+        out=np.empty_like(arr) # batch items must be square to be stored in the same array
+        out[quarter]=np.rot90(arr[quarter],1,(1,2))
+        out[~quarter]=np.rot90(arr[~quarter],2,(1,2))
+        return out
+    
+    return _rot90
         
 
-@augment(prob=1.0)
-def normalize(*arrs):
+@augment(prob=1.0,batched=True,outArg=True)
+def normalize(*arrs,batch=False):
     '''Normalize each of `arrs'.'''
-    return trainutils.rescaleArray
+    if batch:
+        return trainutils.rescaleInstanceArray
+    
+    def _normalize(im,out=None):
+        # bool inputs such as masks can't be subtracted from so go through rescaleArray which converts them first
+        if out is None or out.shape!=im.shape or out.dtype.kind!='f' or im.dtype.kind not in 'iuf':
+            return trainutils.rescaleArray(im)
+        
+        # normalize in place in `out' rather than creating temporary arrays
+        mina,maxa=trainutils.minMax(im)
+        if mina==maxa:
+            out.fill(0)
+        else:
+            np.subtract(im,mina,out=out,casting='unsafe')
+            np.divide(out,maxa-mina,out=out)
+            
+        return out
+    
+    return _normalize
 
 
-@augment(prob=1.0)
-def randPatch(*arrs,patchSize=(32,32)):
-    '''Randomly choose a patch from `arrs' of dimensions `patchSize'.'''
+@augment(prob=1.0,batched=True)
+def flipNormalize(*arrs,flipProb=0.5,batch=False):
+    '''Flip each of `arrs' with probability `flipProb' as `flip' does then normalize them as `normalize' does.'''
+    if not batch:
+        lr=trainutils.randChoice()
+        doFlip=trainutils.randChoice(flipProb)
+        
+        def _flipNormalize(im):
+            if doFlip:
+                im=np.fliplr(im) if lr else np.flipud(im)
+                
+            return trainutils.rescaleArray(im)
+        
+        return _flipNormalize
+    
+    n=arrs[0].shape[0]
+    flipCodes=np.where(np.random.random(n)<=flipProb,np.where(np.random.random(n)<=0.5,1,2),0)
+    
+    return partial(trainutils.flipRescaleBatch,flipCodes=flipCodes)
+
+
+def fuseFlipNormalize(first,second):
+    '''
+    Returns a flipNormalize augment to replace augments `first' and `second' if these are flip and normalize, given 
+    directly or in functools.partial objects with only their `prob' and `applyIndices' arguments, otherwise None.
+    '''
+    def _args(aug):
+        if isinstance(aug,partial) and not aug.args:
+            return aug.func,dict(aug.keywords)
+        else:
+            return aug,{}
+        
+    firstFunc,firstKw=_args(first)
+    secondFunc,secondKw=_args(second)
+    
+    if firstFunc is not flip or secondFunc is not normalize:
+        return None
+    
+    if any(k not in ('prob','applyIndices') for k in list(firstKw)+list(secondKw)):
+        return None
+    
+    indices=firstKw.get('applyIndices',flip.applyIndices)
+    
+    if secondKw.get('prob',normalize.prob)<1.0 or secondKw.get('applyIndices',normalize.applyIndices)!=indices:
+        return None
+    
+    return partial(flipNormalize,flipProb=firstKw.get('prob',flip.prob),applyIndices=indices)
+
+
+flip.batchFuse=fuseFlipNormalize # lets datasource.applyBatchAugments replace flip then normalize with flipNormalize
+        
+        
+@augment(prob=1.0,batched=True)
+def randPatch(*arrs,patchSize=(32,32),nonzeroIndex=-1,maxCount=5,batch=False):
+    '''
+    Randomly choose a patch from `arrs' of dimensions `patchSize'. If `nonzeroIndex' is not -1 the patch is chosen to
+    contain nonzero values of the array at that index, trying `maxCount' times before accepting any patch.
+    '''
     ph,pw=patchSize
+    testim=arrs[0] if batch else arrs[0][np.newaxis]
+    n,h,w=testim.shape[:3]
+    ry=np.random.randint(0,h-ph+1,n)
+    rx=np.random.randint(0,w-pw+1,n)
     
-    def _randPatch():
-        h,w=im.shape[:2]
-        ry=np.random.randint(0,h-ph)
-        rx=np.random.randint(0,w-pw)
+    if nonzeroIndex!=-1:
+        mask=arrs[nonzeroIndex] if batch else arrs[nonzeroIndex][np.newaxis]
+        mask=(mask!=0).reshape(n,h,w,-1).any(3)
+        
+        # summed-area table of the mask so that every candidate patch's nonzero count is found with 4 lookups
+        table=np.zeros((n,h+1,w+1),np.int64)
+        table[:,1:,1:]=mask.cumsum(1).cumsum(2)
+        items=np.arange(n)
+        
+        for _ in range(maxCount-1):
+            sums=table[items,ry+ph,rx+pw]-table[items,ry,rx+pw]-table[items,ry+ph,rx]+table[items,ry,rx]
+            empty=sums==0
+            
+            if not empty.any():
+                break
             
-        return im[ry:ry+ph,rx:rx+pw]
+            ry[empty]=np.random.randint(0,h-ph+1,empty.sum())
+            rx[empty]=np.random.randint(0,w-pw+1,empty.sum())
+            
+    if not batch:
+        return lambda im:im[ry[0]:ry[0]+ph,rx[0]:rx[0]+pw]
+    
+    # index grids selecting every patch from the batch in one fancy-index operation
+    items=np.arange(n)[:,np.newaxis,np.newaxis]
+    rows=ry[:,np.newaxis,np.newaxis]+np.arange(ph)[:,np.newaxis]
+    cols=rx[:,np.newaxis,np.newaxis]+np.arange(pw)
     
-    return _randPatch
+    return lambda im:im[items,rows,cols]
 
         
 @augment()
@@ -129,8 +347,8 @@ def shift(*arrs,dimFract=2,order=3):
     '''Shift arrays randomly by `dimfract' fractions of the array dimensions.'''
     testim=arrs[0]
     x,y=testim.shape[:2]
-    shiftx=np.random.randint(-x//dimFract,x//dimFract)
-    shifty=np.random.randint(-y//dimFract,y//dimFract)
+    shiftx=trainutils.randomBuffer.randint(-x//dimFract,x//dimFract)
+    shifty=trainutils.randomBuffer.randint(-y//dimFract,y//dimFract)
     
     def _shift(im):
         h,w=im.shape[:2]
@@ -147,12 +365,19 @@ def shift(*arrs,dimFract=2,order=3):
 @augment()
 @checkSegmentMargin
 def rotate(*arrs):
-    '''Shift arrays randomly around the array center.'''
+    '''Rotate arrays randomly around the array center.'''
+    h,w=arrs[0].shape[:2]
+    angle=trainutils.randomBuffer.random()*360
     
-    angle=np.random.random()*360
+    if cvAvailable:
+        mat=cv2.getRotationMatrix2D(((w-1)/2,(h-1)/2),angle,1.0)
+        warp=lambda im:cv2.warpAffine(im,mat,(w,h),flags=cv2.INTER_LINEAR,borderMode=cv2.BORDER_CONSTANT)
     
     def _rotate(im):
-        return scipy.ndimage.rotate(im,angle=angle,reshape=False)
+        if cvAvailable and im.ndim<=3:
+            return cvTransform(im,warp)
+        else:
+            return scipy.ndimage.rotate(im,angle=angle,reshape=False)
     
     return _rotate
 
@@ -162,17 +387,91 @@ def rotate(*arrs):
 def zoom(*arrs,zoomrange=0.2):
     '''Return the image/mask pair zoomed by a random amount with the mask kept within `margin' pixels of the edges.'''
     
-    z=zoomrange-np.random.random()*zoomrange*2
-    zx=z+1.0+zoomrange*0.25-np.random.random()*zoomrange*0.5
-    zy=z+1.0+zoomrange*0.25-np.random.random()*zoomrange*0.5
+    h,w=arrs[0].shape[:2]
+    zx,zy=randZoomFactors(zoomrange)
+    
+    if cvAvailable:
+        # scale about the center directly into an output of the original size, this replaces the zoom then crop/pad
+        cy,cx=(h-1)/2,(w-1)/2
+        mat=np.float32([[zy,0,cx*(1-zy)],[0,zx,cy*(1-zx)]])
+        warp=lambda im:cv2.warpAffine(im,mat,(w,h),flags=cv2.INTER_LINEAR,borderMode=cv2.BORDER_CONSTANT)
         
     def _zoom(im):
-        ztemp=scipy.ndimage.zoom(im,(zx,zy)+tuple(1 for _ in range(2,im.ndim)),order=2)
-        return trainutils.resizeCenter(ztemp,*im.shape)
+        if cvAvailable and im.ndim<=3:
+            return cvTransform(im,warp)
+        else:
+            ztemp=scipy.ndimage.zoom(im,(zx,zy)+tuple(1 for _ in range(2,im.ndim)),order=2)
+            return trainutils.resizeCenter(ztemp,*im.shape)
             
     return _zoom
 
 
+@augment()
+@checkSegmentMargin
+def affine(*arrs,transforms=(('shift',1.0),('rotate',1.0),('zoom',1.0)),dimFract=2,zoomrange=0.2):
+    '''
+    Apply the random transforms named in the (name,probability) pairs of `transforms', in that order, as a single
+    affine transform so that arrays are interpolated once rather than once per transform. The names are "shift", 
+    "rotate", and "zoom", which choose parameters like the augments of the same names using `dimFract' and `zoomrange'.
+    OpenCV is used for 2D and HxWxC arrays, SciPy otherwise.
+    '''
+    h,w=arrs[0].shape[:2]
+    cy,cx=(h-1)/2,(w-1)/2
+    mat=np.eye(3)
+    
+    for name,prob in transforms:
+        if prob<1.0 and not trainutils.randChoice(prob):
+            continue
+        elif name=='shift':
+            shiftx=trainutils.randomBuffer.randint(-h//dimFract,h//dimFract)
+            shifty=trainutils.randomBuffer.randint(-w//dimFract,w//dimFract)
+            step=[[1,0,-shifty],[0,1,-shiftx],[0,0,1]]
+        elif name=='rotate':
+            angle=np.deg2rad(trainutils.randomBuffer.random()*360)
+            cos,sin=np.cos(angle),np.sin(angle) # same matrix as cv2.getRotationMatrix2D
+            step=[[cos,sin,(1-cos)*cx-sin*cy],[-sin,cos,sin*cx+(1-cos)*cy],[0,0,1]]
+        elif name=='zoom':
+            zx,zy=randZoomFactors(zoomrange)
+            step=[[zy,0,cx*(1-zy)],[0,zx,cy*(1-zx)],[0,0,1]]
+        else:
+            raise ValueError('Unknown transform %r'%name)
+            
+        mat=np.dot(step,mat)
+        
+    # SciPy maps output (row,column) indices to input indices so needs the inverse with the x and y axes swapped
+    inv=np.linalg.inv(mat)
+    invmat=inv[1::-1,1::-1]
+    invoffset=inv[1::-1,2]
+    mat=mat[:2]
+    
+    if cvAvailable:
+        warp=lambda im:cv2.warpAffine(im,mat,(w,h),flags=cv2.INTER_LINEAR,borderMode=cv2.BORDER_CONSTANT)
+        
+    def _affine(im):
+        if cvAvailable and im.ndim<=3:
+            return cvTransform(im,warp)
+        else:
+            fullmat=np.eye(im.ndim) # leave dimensions past the first two unchanged
+            fullmat[:2,:2]=invmat
+            offset=np.zeros(im.ndim)
+            offset[:2]=invoffset
+            return scipy.ndimage.affine_transform(im,fullmat,offset,order=1)
+    
+    return _affine
+
+
+if cvAvailable: # lets datasource.compileAugments merge consecutive uses of these augments into one affine augment
+    shift.affineName='shift'
+    shift.affineArgs=('dimFract',)
+    rotate.affineName='rotate'
+    rotate.affineArgs=()
+    zoom.affineName='zoom'
+    zoom.affineArgs=('zoomrange',)
+    
+    for _aug in (shift,rotate,zoom):
+        _aug.affineMerge=affine
+
+
 @augment()
 @checkSegmentMargin
 def rotateZoomPIL(*arrs,margin=5,minFract=0.5,maxFract=2,resample=0):
@@ -214,17 +513,30 @@ def rotateZoomPIL(*arrs,margin=5,minFract=0.5,maxFract=2,resample=0):
 @augment()
 def deformPIL(*arrs,defrange=25,numControls=3,margin=2,mapOrder=1):
     '''Deforms arrays randomly with a deformation grid of size `numControls'**2 with `margins' grid values fixed.'''
-    assert pilAvailable,'PIL (pillow) not installed'
+    assert pilAvailable or cvAvailable,'Neither OpenCV (opencv-python) nor PIL (pillow) are installed'
     
     h,w = arrs[0].shape[:2]
     
-    imshift=np.zeros((2,numControls+margin*2,numControls+margin*2))
+    imshift=np.zeros((2,numControls+margin*2,numControls+margin*2),np.float32)
     imshift[:,margin:-margin,margin:-margin]=np.random.randint(-defrange,defrange,(2,numControls,numControls))
+    
+    y,x=gridIndices(h,w)
+    
+    if cvAvailable:
+        imshiftx=cv2.resize(imshift[0],(w,h),interpolation=cv2.INTER_CUBIC)
+        imshifty=cv2.resize(imshift[1],(w,h),interpolation=cv2.INTER_CUBIC)
+        
+        # remap takes column coordinates first then row coordinates, all channels are mapped in one call
+        mapx=(y+imshifty).astype(np.float32)
+        mapy=(x+imshiftx).astype(np.float32)
+        interp=cv2.INTER_NEAREST if mapOrder==0 else cv2.INTER_LINEAR if mapOrder==1 else cv2.INTER_CUBIC
+        remap=lambda im:cv2.remap(im,mapx,mapy,interp,borderMode=cv2.BORDER_CONSTANT)
+        
+        return partial(cvTransform,func=remap)
 
     imshiftx=np.array(Image.fromarray(imshift[0]).resize((w,h),Image.QUAD))
     imshifty=np.array(Image.fromarray(imshift[1]).resize((w,h),Image.QUAD))
         
-    y,x=np.meshgrid(np.arange(w), np.arange(h))
     indices=np.reshape(x+imshiftx, (-1, 1)),np.reshape(y+imshifty, (-1, 1))
 
     def _mapChannels(im):
@@ -239,30 +551,21 @@ def deformPIL(*arrs,defrange=25,numControls=3,margin=2,mapOrder=1):
     return _mapChannels
 
 
-@augment()
-def distortFFT(*arrs,minDist=0.1,maxDist=1.0):
+@augment(batched=True)
+def distortFFT(*arrs,minDist=0.1,maxDist=1.0,batch=False):
     '''Distorts arrays by applying dropout in k-space with a per-pixel probability based on distance from center.'''
-    h,w=arrs[0].shape[:2]
+    shape=arrs[0].shape[:3 if batch else 2] # dropout is chosen per batch item and shared by all channels
+    axes=(1,2) if batch else (0,1)
+    h,w=shape[-2:]
 
-    x,y=np.meshgrid(np.linspace(-1,1,h),np.linspace(-1,1,w))
-    probfield=np.sqrt(x**2+y**2)
-    
-    if arrs[0].ndim==3:
-        probfield=np.repeat(probfield[...,np.newaxis],arrs[0].shape[2],2)
-    
-    dropout=np.random.uniform(minDist,maxDist,arrs[0].shape)>probfield
+    probfield=centerDistanceField(h,w)
+    dropout=np.random.uniform(minDist,maxDist,shape)>probfield
 
     def _distort(im):
-        if im.ndim==2:
-            result=ft.fft2(im)
-            result=ft.fftshift(result)
-            result=result*dropout[:,:,0]
-            result=ft.ifft2(result)
-            result=np.abs(result)
-        else:
-            result=np.dstack([_distort(im[...,i]) for i in range(im.shape[-1])])
-            
-        return result
+        mask=dropout.reshape(shape+(1,)*(im.ndim-len(shape)))
+        result=ft.fftshift(ft.fft2(im,axes=axes,workers=-1),axes=axes)
+        result*=mask
+        return np.abs(ft.ifft2(result,axes=axes,workers=-1))
     
     return _distort
 
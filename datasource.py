@@ -2,18 +2,27 @@
 from __future__ import division, print_function
 import threading
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import platform
 import queue
+import random
+from functools import partial
 from multiprocessing import sharedctypes
 from contextlib import contextmanager, ExitStack
+from collections import OrderedDict
 
 import numpy as np
 
 
 def toShared(array):
     '''Convert the given Numpy array to a shared ctypes object.'''
-    carr=np.ctypeslib.as_ctypes(array)
-    return sharedctypes.RawArray(carr._type_, carr)
+    ctype=np.ctypeslib.as_ctypes_type(array.dtype)
+    for dim in reversed(array.shape[1:]): # nest the element type so that fromShared recovers the array's shape
+        ctype=ctype*dim
+    
+    raw=sharedctypes.RawArray(ctype,array.shape[0])
+    np.copyto(np.ctypeslib.as_array(raw),array) # a single memory copy rather than iterating over the ctypes object
+    return raw
 
 
 def fromShared(array):
@@ -21,38 +30,240 @@ def fromShared(array):
     return np.ctypeslib.as_array(array)
         
         
-def initProc(inArrays_,augs_,augments_):
+def compileAugments(augments):
+    '''
+    Returns a callable applying `augments' in sequence to its positional arguments and returning the resulting tuple.
+    Augments created with augments.augment, including those wrapped with keyword arguments in functools.partial, have 
+    their probability and index choices resolved once here so that applying them calls the underlying augment function
+    directly. Consecutive affine augments are merged into one affine transform using mergeAffineStep. Other augments
+    are called as they are. The callable accepts an `outs' keyword argument giving arrays to store the results in, 
+    these are used by the last augment if it has a true `outArg' attribute and are otherwise ignored, so callers should
+    copy results into `outs' which aren't already those arrays.
+    '''
+    steps=[]
+    
+    for aug in augments:
+        func=aug
+        kwargs={}
+        
+        if isinstance(aug,partial) and not aug.args:
+            func=aug.func
+            kwargs=dict(aug.keywords)
+            
+        if hasattr(func,'augmentFunc'):
+            prob=kwargs.pop('prob',func.prob)
+            indices=kwargs.pop('applyIndices',func.applyIndices)
+            indices=frozenset(indices) if indices else None # empty means all arrays as with the augment decorator
+            
+            merged=mergeAffineStep(steps[-1],func,kwargs,prob,indices) if steps else None
+            if merged:
+                steps[-1]=merged
+            else:
+                steps.append((func.augmentFunc,kwargs,prob,indices,func.outArg,func))
+        else:
+            steps.append((aug,None,1.0,None,False,aug))
+            
+    steps=[step[:5] for step in steps]
+            
+    def _pipeline(*arrays,outs=None):
+        for n,(func,kwargs,prob,indices,outArg) in enumerate(steps):
+            if kwargs is None:
+                arrays=func(*arrays)
+            elif prob>=1.0 or random.random()<=prob:
+                op=func(*arrays,**kwargs)
+                useOut=outs is not None and outArg and n==len(steps)-1
+                results=[]
+                
+                for i,im in enumerate(arrays):
+                    if indices is not None and i not in indices:
+                        results.append(im)
+                    elif useOut:
+                        results.append(op(im,out=outs[i]))
+                    else:
+                        results.append(op(im))
+                        
+                arrays=tuple(results)
+                
+        return arrays
+    
+    return _pipeline
+
+
+def mergeAffineStep(step,func,kwargs,prob,indices):
+    '''
+    Returns a pipeline step merging augment `func', with arguments `kwargs', probability `prob', and `indices', into
+    the previous step `step' as one affine augment, or None if they can't be merged. This is possible if both are 
+    affine augments (having an `affineMerge' attribute) applied to the same indices with the same arguments. Augments
+    with a segmentation margin check (`nonzeroIndex' given) aren't merged since a failed check would then replace all
+    of the merged transforms with the identity rather than only the failing one.
+    '''
+    lastFunc,lastKwargs,lastProb,lastIndices,_,lastAug=step
+    marginArgs=('margin','maxCount','nonzeroIndex')
+    
+    if not hasattr(func,'affineMerge') or lastIndices!=indices:
+        return None
+    
+    if any(k not in marginArgs+func.affineArgs for k in kwargs):
+        return None
+    
+    if hasattr(lastAug,'affineMerge'): # previous step is a single affine augment, convert it to the merged form
+        if any(k not in marginArgs+lastAug.affineArgs for k in lastKwargs):
+            return None
+        
+        lastKwargs=dict(lastKwargs,transforms=((lastAug.affineName,lastProb),))
+    elif lastAug is not func.affineMerge or lastProb<1.0 or 'transforms' not in lastKwargs:
+        return None
+    
+    lastNames=[name for name,_ in lastKwargs['transforms']]
+    
+    if any(lastKwargs.get(k)!=kwargs.get(k) for k in marginArgs) or kwargs.get('nonzeroIndex',-1)!=-1:
+        return None
+    
+    if any(lastKwargs.get(k)!=kwargs.get(k) for k in func.affineArgs if k in lastKwargs or func.affineName in lastNames):
+        return None
+    
+    affine=func.affineMerge
+    mergedKwargs=dict(lastKwargs,**kwargs)
+    mergedKwargs['transforms']=lastKwargs['transforms']+((func.affineName,prob),)
+    
+    return (affine.augmentFunc,mergedKwargs,1.0,indices,affine.outArg,affine)
+    
+    
+def isBatchAugments(augments):
+    '''Returns True if every augment in `augments' can be applied to whole batches, ie. has a true `batched' attribute.'''
+    return all(getattr(aug.func if isinstance(aug,partial) else aug,'batched',False) for aug in augments)
+
+
+def fuseBatchAugments(augments):
+    '''
+    Returns the list of `augments' with consecutive pairs replaced by a single fused augment where possible. The first
+    of a pair can be fused if it has a `batchFuse' attribute, this is called with the pair and returns the replacement
+    augment or None if they can't be fused.
+    '''
+    fused=[]
+    
+    for aug in augments:
+        if fused:
+            last=fused[-1]
+            fuse=getattr(last.func if isinstance(last,partial) else last,'batchFuse',None)
+            replacement=fuse(last,aug) if fuse else None
+            
+            if replacement is not None:
+                fused[-1]=replacement
+                continue
+                
+        fused.append(aug)
+        
+    return fused
+
+
+def applyBatchAugments(augments,arrays,augArrays,indices):
+    '''Apply the batchable `augments' to `arrays' at `indices' all at once, storing the results in `augArrays'.'''
+    indices=np.asarray(indices)
+    inarrs=[a[indices] for a in arrays]
+    
+    for aug in fuseBatchAugments(augments):
+        inarrs=aug(*inarrs,batch=True)
+        
+    for ina,outa in zip(inarrs,augArrays):
+        outa[indices]=ina
+        
+        
+def initProc(inArrays_,augBuffers_,augments_):
     '''Initialize subprocesses by setting global variables.'''
     global inArrays
-    global augs
+    global augBuffers
     global augments
+    global pipeline
     inArrays=tuple(map(fromShared,inArrays_))
-    augs=tuple(map(fromShared,augs_))
+    augBuffers=[tuple(map(fromShared,b)) for b in augBuffers_]
     augments=augments_
+    pipeline=compileAugments(augments_)
     
     
-def applyAugmentsProc(indices):
-    '''Apply the augmentations to the input array at the given indices.'''
+def applyAugmentsProc(bufferIndices):
+    '''Apply the augmentations to the input array at the given indices, storing results in the given output buffer.'''
     global inArrays
-    global augs
+    global augBuffers
     global augments
+    global pipeline
+    
+    bufferIndex,indices=bufferIndices
+    augs=augBuffers[bufferIndex]
+    
+    if isBatchAugments(augments):
+        applyBatchAugments(augments,inArrays,augs,indices)
+        return
     
     for i in indices:
-        inarrs=[a[i] for a in inArrays]
-        
-        for aug in augments:
-            inarrs=aug(*inarrs)
+        outs=[a[i,...] for a in augs]
+        inarrs=pipeline(*[a[i] for a in inArrays],outs=outs)
             
-        for ina,outa in zip(inarrs,augs):
-            outa[i]=ina
+        for ina,outa in zip(inarrs,outs):
+            if ina is not outa:
+                outa[...]=ina
         
 
+class BatchBufferPool(object):
+    '''
+    Pool of preallocated batch buffers, each being a tuple of arrays in the list `buffers'. A producer acquires a free
+    buffer index with acquire(), fills that buffer, then passes the index to put(). The consumer receives filled buffers
+    from get(), the buffer returned by the previous call to get() is only released back to the pool when get() is called
+    again so a batch remains valid until the next is requested. Exceptions can be passed to put() instead of indices 
+    and are raised by get(). Calling close() causes acquire() to return None, which the producer must treat as a signal
+    to stop.
+    '''
+    def __init__(self,buffers):
+        self.buffers=list(map(tuple,buffers))
+        self.freeQueue=queue.Queue()
+        self.readyQueue=queue.Queue()
+        self.heldIndex=None
+        
+        for i in range(len(self.buffers)):
+            self.freeQueue.put(i)
+            
+    def acquire(self):
+        '''Returns the index of a free buffer, blocking until one is available, or None if the pool was closed.'''
+        index=self.freeQueue.get()
+        if index is None:
+            self.freeQueue.put(None) # keep the sentinel for any other waiting producers
+            
+        return index
+    
+    def put(self,index):
+        '''Mark the buffer at `index' as filled, or pass an exception to raise in the consumer.'''
+        self.readyQueue.put(index)
+        
+    def release(self):
+        '''Release the buffer last returned by get() back to the pool.'''
+        if self.heldIndex is not None:
+            self.freeQueue.put(self.heldIndex)
+            self.heldIndex=None
+        
+    def close(self):
+        '''Release the held buffer and wake any producer blocked in acquire() so that it can exit.'''
+        self.release()
+        self.freeQueue.put(None)
+        
+    def get(self):
+        '''Release the previously returned buffer and return the next filled one, blocking until one is ready.'''
+        self.release()
+        v=self.readyQueue.get()
+        if isinstance(v,Exception):
+            raise v
+            
+        self.heldIndex=v
+        return self.buffers[v]
+    
+    
 class DataSource(object):
     def __init__(self,*arrays,dataGen=None,selectProbs=None,augments=[]):
         self.arrays=list(arrays)
         self.dataGen=dataGen or self.defaultDataGen
         self.selectProbs=selectProbs
         self.augments=augments
+        self.pipelineAugments=None
+        self.pipeline=None
         
     def defaultDataGen(self,batchSize=None,selectProbs=None,chosenInds=None):
         if chosenInds is None:
@@ -73,20 +284,35 @@ class DataSource(object):
     
     def getAugmentedArrays(self,arrays):
         '''Apply the augmentations to single-instance arrays.'''
-        for aug in self.augments:
-            arrays=aug(*arrays)
+        return self.getPipeline()(*arrays)
+    
+    def getPipeline(self):
+        '''Returns the compiled callable applying self.augments, recompiling only when the augments have changed.'''
+        augs=tuple(self.augments)
+        
+        if self.pipelineAugments!=augs:
+            self.pipeline=compileAugments(augs)
+            self.pipelineAugments=augs
             
-        return arrays
+        return self.pipeline
     
     def applyAugments(self,arrays,augArrays,indices=None):
         '''Apply the augmentations to batch input and output arrays at `indices' or for the whole arrays if not given.'''
         indices=range(arrays[0].shape[0]) if indices is None else indices
+        
+        if isBatchAugments(self.augments):
+            applyBatchAugments(self.augments,arrays,augArrays,indices)
+            return
+            
+        pipeline=self.getPipeline()
             
         for i in indices:
-            inarrs=[a[i] for a in arrays]
-            outarrs=self.getAugmentedArrays(inarrs)
-            for out,aug in zip(outarrs,augArrays):
-                aug[i]=out
+            outs=[a[i,...] for a in augArrays] # views, 0-d for 1D arrays
+            outarrs=pipeline(*[a[i] for a in arrays],outs=outs)
+            
+            for out,dest in zip(outarrs,outs):
+                if out is not dest: # the last augment may have written its result directly into the batch array
+                    dest[...]=out
                 
     @contextmanager
     def localBatchGen(self,batchSize):
@@ -107,102 +333,104 @@ class DataSource(object):
             self.stop('local')
                 
     @contextmanager
-    def threadBatchGen(self,batchSize,numThreads=None):
-        '''Yields a callable object which produces `batchSize' batches generated in `numThreads' threads.'''
+    def threadBatchGen(self,batchSize,numThreads=None,numBuffers=3):
+        '''
+        Yields a callable object which produces `batchSize' batches generated in `numThreads' threads.
+        Batch arrays are reused from a pool of `numBuffers' (at least 2) so each batch is valid only until the next is
+        requested.
+        '''
         numThreads=min(batchSize,numThreads or mp.cpu_count())
         threadIndices=np.array_split(np.arange(batchSize),numThreads)
         isRunning=True
-        batchQueue=queue.Queue(1)
         
         with self.localBatchGen(batchSize) as gen:
             augs=gen()
+            pool=BatchBufferPool([augs]+[tuple(map(np.zeros_like,augs)) for _ in range(numBuffers-1)])
         
         def _batchThread():
-            while isRunning:
-                threads=[]
-                batch=self.getRandomBatch(batchSize)
-                
-                for indices in threadIndices:
-                    t=threading.Thread(target=self.applyAugments,args=(batch,augs,indices))
-                    t.start()
-                    threads.append(t)
-                    
-                for t in threads:
-                    t.join()
-                    
-                batchQueue.put(tuple(a.copy() for a in augs)) # copy to prevent overwriting arrays before they're used
+            try:
+                with ThreadPool(numThreads) as tp: # persistent workers, augments which release the GIL run in parallel
+                    while isRunning:
+                        index=pool.acquire() # augment directly into a free buffer rather than copying a shared one
+                        if index is None:
+                            break
+                        
+                        augs=pool.buffers[index]
+                        batch=self.getRandomBatch(batchSize)
+                        
+                        tp.map(lambda indices:self.applyAugments(batch,augs,indices),threadIndices)
+                        pool.put(index)
+                        
+            except Exception as e:
+                pool.put(e)
                 
         batchThread=threading.Thread(target=_batchThread)
         batchThread.start()
         
         try:
-            yield batchQueue.get
+            yield pool.get
         finally:
             isRunning=False
             self.stop('thread')
-            try:
-                batchQueue.get(True) # there may be a batch waiting on the queue, batchThread is stuck until this is removed
-            except queue.Empty:
-                pass
+            pool.close() # batchThread may be waiting for a free buffer, this wakes it so it can exit
             
     @contextmanager
-    def processBatchGen(self,batchSize,numProcs=None):
-        '''Yields a callable object which produces `batchSize' batches generated in `numProcs' subprocesses.'''
+    def processBatchGen(self,batchSize,numProcs=None,numBuffers=3):
+        '''
+        Yields a callable object which produces `batchSize' batches generated in `numProcs' subprocesses.
+        Batch arrays are reused from a pool of `numBuffers' (at least 2) so each batch is valid only until the next is
+        requested.
+        '''
         assert platform.system().lower()!='windows', 'Generating batches with processes requires fork() semantics not present in Windows.'
         
         numProcs=min(batchSize,numProcs or mp.cpu_count())
         procIndices=np.array_split(np.arange(batchSize),numProcs)
         isRunning=True
-        batchQueue=mp.Queue(1)
         
         with self.localBatchGen(batchSize) as gen:
-            augs=tuple(map(toShared,gen()))
-        
+            augs=gen()
+            augBuffers=[tuple(map(toShared,augs)) for _ in range(numBuffers)]
+            
+        # subprocesses write directly into the shared buffers so only buffer indices are passed between processes
+        pool=BatchBufferPool([tuple(map(fromShared,b)) for b in augBuffers])
         inArrays=tuple(map(toShared,self.getIndexBatch(np.arange(batchSize))))
         
         maugs=self.augments
-        initargs=(inArrays,augs,maugs)
+        initargs=(inArrays,augBuffers,maugs)
                
-        def _batchThread(inArrays,augs,maugs):
+        def _batchThread(inArrays,augBuffers,maugs):
             try:
-                initargs=(inArrays,augs,maugs)
+                initargs=(inArrays,augBuffers,maugs)
                 
                 with mp.Pool(numProcs,initializer=initProc,initargs=initargs) as p:
                     inArrays=tuple(map(fromShared,inArrays))
-                    augs=tuple(map(fromShared,augs))
                         
                     while isRunning:
                         batch=self.getRandomBatch(batchSize)
                         for a,b in zip(inArrays,batch):
                             a[...]=b
                             
+                        index=pool.acquire()
+                        if index is None:
+                            break
+                        
                         if maugs:
-                            p.map(applyAugmentsProc,procIndices)
-
-                        batchQueue.put(tuple(a.copy() for a in augs))
+                            p.map(applyAugmentsProc,[(index,indices) for indices in procIndices])
+                            
+                        pool.put(index)
                         
             except Exception as e:
-                batchQueue.put(e)
+                pool.put(e)
                 
         batchThread=threading.Thread(target=_batchThread,args=initargs)
         batchThread.start()
         
-        def _get():
-            v=batchQueue.get()
-            if not isinstance(v,tuple):
-                raise v
-                
-            return v
-        
         try:
-            yield _get
+            yield pool.get
         finally:
             isRunning=False
             self.stop('process')
-            try:
-                batchQueue.get(True) # there may be a batch waiting on the queue, batchThread is stuck until this is removed
-            except queue.Empty:
-                pass
+            pool.close()
         
         
 def randomDataSource(shape,augments=[],dtype=np.float32):
@@ -221,26 +449,52 @@ def randomDataSource(shape,augments=[],dtype=np.float32):
 
         
 class BufferDataSource(DataSource):
+    '''
+    DataSource whose arrays are appended to over time. Appended arrays are kept as a list of chunks which batches are
+    selected from directly, so appending doesn't copy the whole buffer.
+    '''
+    def __init__(self,*arrays,selectProbs=None,augments=[]):
+        super().__init__(dataGen=self._dataGen,selectProbs=selectProbs,augments=augments)
+        self.chunks=[]
+        self.chunkStarts=np.zeros((0,),np.int64) # index in the whole buffer of the first item of each chunk
+        
+        if arrays:
+            self.appendBuffer(*arrays)
+        
     def appendBuffer(self,*arrays):
-        if not self.arrays:
-            self.arrays=list(arrays)
-        else:
-            for i in range(len(self.arrays)):
-                self.arrays[i]=np.concatenate([self.arrays[i],arrays[i]])
+        self.chunkStarts=np.append(self.chunkStarts,self.bufferSize())
+        self.chunks.append(tuple(arrays))
                 
         if self.selectProbs is not None:
-            size=self.arrays[0].shape[0]
+            size=self.bufferSize()
             self.selectProbs=np.ones((size,))/size
             
     def clearBuffer(self):
         if self.bufferSize()>0:
-            self.arrays=[]
+            self.chunks=[]
+            self.chunkStarts=self.chunkStarts[:0]
             
             if self.selectProbs is not None:
                 self.selectProbs=self.selectProbs[:0]
             
     def bufferSize(self):
-        return 0 if not self.arrays else self.arrays[0].shape[0]
+        return 0 if not self.chunks else self.chunkStarts[-1]+self.chunks[-1][0].shape[0]
+    
+    def _dataGen(self,batchSize=None,selectProbs=None,chosenInds=None):
+        if chosenInds is None:
+            chosenInds=np.random.choice(self.bufferSize(),batchSize,p=selectProbs)
+            
+        chosenInds=np.asarray(chosenInds)
+        chunkInds=np.searchsorted(self.chunkStarts,chosenInds,'right')-1
+        localInds=chosenInds-self.chunkStarts[chunkInds]
+        outs=tuple(np.zeros((len(chosenInds),)+a.shape[1:],a.dtype) for a in self.chunks[0])
+        
+        for c in np.unique(chunkInds): # gather from each chunk only the items chosen from it
+            selected=chunkInds==c
+            for out,arr in zip(outs,self.chunks[c]):
+                out[selected]=arr[localInds[selected]]
+                
+        return outs
 
     
 class MergeDataSource(DataSource):
@@ -275,7 +529,12 @@ class MergeDataSource(DataSource):
         
 
 class FileDataSource(DataSource):
-    def __init__(self,*filelists,maxSize=100*(2**20), selectProbs=None,augments=[]):
+    def __init__(self,*filelists,maxSize=100*(2**20), selectProbs=None,augments=[],numIOThreads=4):
+        '''
+        Create a source for images loaded from the files in the equal-length lists `filelists', caching up to `maxSize'
+        bytes of loaded images. If `numIOThreads' is greater than 0 the files for the next randomly chosen batch are 
+        loaded in that many background threads while the current batch is being used, close() stops these threads.
+        '''
         assert all(len(f)==len(filelists[0]) for f in filelists), "All members of `filelists' must be the same length"
         
         import imageio
@@ -283,37 +542,89 @@ class FileDataSource(DataSource):
         import PIL
         self.image=PIL.Image
         
-        self.imageCache={}
+        try:
+            import cv2
+            self.cv2=cv2
+        except ImportError:
+            self.cv2=None
+        
+        self.cvModes=('L','RGB','RGBA','I;16') # PIL image modes which OpenCV loads as the same arrays
+        self.imageCache=OrderedDict() # kept in least to most recently used order
+        self.cacheLock=threading.Lock()
         self.currentSize=0
         self.maxSize=maxSize
+        self.ioPool=ThreadPool(numIOThreads) if numIOThreads>0 else None
+        self.nextInds=None
+        self.prefetchResult=None
         super().__init__(*list(map(np.asarray,filelists)),dataGen=self._dataGen,selectProbs=selectProbs,augments=augments)
         
     def loadFile(self,path):
 #        return self.iio.imread(path)
-        return np.asarray(self.image.open(path)).copy()
+        with self.image.open(path) as pim: # opening only reads the header, pixel data is loaded by asarray()
+            # OpenCV is only used for modes it loads identically to PIL, it would expand palette images to colour, 
+            # load 1-bit images as 0/255 uint8 rather than bool, and load LA images with 4 channels 
+            if self.cv2 is None or pim.mode not in self.cvModes:
+                return np.asarray(pim).copy()
+            
+        im=self.cv2.imread(path,self.cv2.IMREAD_UNCHANGED) # None if OpenCV can't read the file's format
+        
+        if im is None:
+            return np.asarray(self.image.open(path)).copy()
+        
+        if im.ndim==3 and im.shape[2] in (3,4): # OpenCV loads colour channels in BGR(A) order
+            im=self.cv2.cvtColor(im,self.cv2.COLOR_BGR2RGB if im.shape[2]==3 else self.cv2.COLOR_BGRA2RGBA)
+            
+        return im
         
     def _getCachedFile(self,path):
-        if path not in self.imageCache:
-            im=self.loadFile(path)
-            self.currentSize+=im.nbytes
-            self.imageCache[path]=im
+        with self.cacheLock:
+            im=self.imageCache.get(path)
+            if im is not None:
+                self.imageCache.move_to_end(path)
+                return im
+        
+        im=self.loadFile(path) # load outside the lock so that files can be read concurrently
+        
+        with self.cacheLock:
+            if path not in self.imageCache:
+                self.currentSize+=im.nbytes
+                self.imageCache[path]=im
             
-        return self.imageCache[path]
+        return im
 
+    def close(self):
+        '''Stop the background loading threads, waiting for any files being loaded to finish.'''
+        if self.ioPool is not None:
+            self.ioPool.close()
+            self.ioPool.join()
+            self.ioPool=None
+            self.prefetchResult=None
+            
+    def __del__(self):
+        if getattr(self,'ioPool',None) is not None:
+            self.ioPool.terminate()
+        
     def _removeFiles(self):
         if self.maxSize<=0:
             return 
         
-        candidates=list(self.imageCache)        
-        while len(candidates)>0 and self.currentSize>self.maxSize:
-            c=candidates.pop(0)
-            im=self.imageCache[c]
-            self.currentSize-=im.nbytes
-            del self.imageCache[c]
+        with self.cacheLock:
+            while self.imageCache and self.currentSize>self.maxSize:
+                _,im=self.imageCache.popitem(last=False)
+                self.currentSize-=im.nbytes
         
     def _dataGen(self,batchSize=None,selectProbs=None,chosenInds=None):
+        prefetch=chosenInds is None and self.ioPool is not None
+        
+        if self.prefetchResult is not None: # wait for files still being loaded so they aren't loaded a second time
+            self.prefetchResult.wait()
+            self.prefetchResult=None
+        
         if chosenInds is None:
-            chosenInds=np.random.choice(self.arrays[0].shape[0],batchSize,p=selectProbs)
+            if self.nextInds is not None and len(self.nextInds)==batchSize:
+                chosenInds=self.nextInds
+            else:
+                chosenInds=np.random.choice(self.arrays[0].shape[0],batchSize,p=selectProbs)
             
         outs=[]
         for arr in self.arrays:
@@ -328,6 +639,11 @@ class FileDataSource(DataSource):
             
         self._removeFiles()
         
+        if prefetch: # choose the next batch now and load its files in the background while this one is used
+            self.nextInds=np.random.choice(self.arrays[0].shape[0],batchSize,p=selectProbs)
+            paths=[c for arr in self.arrays for c in arr[self.nextInds]]
+            self.prefetchResult=self.ioPool.map_async(self._getCachedFile,paths)
+        
         return tuple(outs)
     
     
@@ -2,6 +2,7 @@
 # Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
 
 from __future__ import print_function, division
+import math
 import numpy as np
 import torch
 import torch.nn as nn
@@ -49,16 +50,30 @@ def addNormalNoise(m, mean=0, std=1e-5):
     return m + noise
 
 
+def scriptForInference(net, *inputs):
+    '''
+    Returns a TorchScript version of `net' traced with the example `inputs' in eval mode, frozen and optimized for 
+    inference. Freezing lets TorchScript fold batch norms into convolutions and fuse chains of pointwise operations
+    into single kernels. The result is a snapshot of the current parameters so must be recreated if `net' is trained.
+    '''
+    net.eval()
+    with torch.no_grad():
+        net(*inputs)  # populate cached state such as folded batch norms so that each traced invocation is the same
+        traced = torch.jit.trace(net, inputs)
+
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
 def predictSegmentation(logits):
     '''
     Given the logits from a network, computing the segmentation by thresholding all values above 0 if `logits' has one
     channel, or computing the argmax along the channel axis otherwise.
     '''
-    # generate prediction outputs, logits has shape BCHW[D]
+    # generate prediction outputs, logits has shape BCHW[D], results stay on the device of `logits'
     if logits.shape[1] == 1:
-        return (logits[:, 0] >= 0).type(torch.IntTensor)  # for binary segmentation threshold on channel 0
+        return (logits[:, 0] >= 0).to(torch.uint8)  # for binary segmentation threshold on channel 0
     else:
-        return logits.max(1)[1]  # take the index of the max value along dimension 1
+        return logits.argmax(1)  # take the index of the max value along dimension 1
 
 
 def gaussianConv(numChannels, dimensions, kernelSize, stride=2, sigma=0.75):
@@ -180,13 +195,14 @@ class DiceLoss(_Loss):
                 source = source[:, 1:]
 
         batchsize = target.size(0)
-        tsum = tsum.float().view(batchsize, -1)
-        psum = psum.view(batchsize, -1)
+        tsum = tsum.float().reshape(batchsize, -1)
+        psum = psum.reshape(batchsize, -1)
 
-        intersection = psum * tsum
-        sums = psum + tsum
+        # reduce directly rather than materializing the elementwise product and sum tensors
+        intersection = torch.einsum('bn,bn->b', psum, tsum)
+        sums = psum.sum(1) + tsum.sum(1)
 
-        score = 2.0 * (intersection.sum(1) + smooth) / (sums.sum(1) + smooth)
+        score = 2.0 * (intersection + smooth) / (sums + smooth)
         return 1 - score.sum() / batchsize
 
 
@@ -342,11 +358,16 @@ class UpsampleShuffle2D(nn.Sequential):
 
 class Convolution2D(nn.Sequential):
     def __init__(self, inChannels, outChannels, strides=1, kernelSize=3, instanceNorm=True,
-                 dropout=0, dilation=1, bias=True, convOnly=False, isTransposed=False):
+                 dropout=0, dilation=1, bias=True, convOnly=False, isTransposed=False, activation='prelu'):
         super(Convolution2D, self).__init__()
+        assert activation in ('relu', 'prelu'), 'Activation should be "relu" or "prelu", not %r' % (activation,)
         self.inChannels = inChannels
         self.outChannels = outChannels
         self.isTransposed = isTransposed
+        self.activation = activation
+        # batch norm in eval mode is an affine transform with fixed statistics so it can be folded into the conv
+        self.canFuse = not (convOnly or isTransposed or instanceNorm)
+        self._fusedParams = None
 
         padding = samePadding(kernelSize, dilation)
         normalizeFunc = nn.InstanceNorm2d if instanceNorm else nn.BatchNorm2d
@@ -364,12 +385,73 @@ class Convolution2D(nn.Sequential):
             if dropout > 0:  # omitting Dropout2d appears faster than relying on it short-circuiting when dropout==0
                 self.add_module('dropout', nn.Dropout2d(dropout))
 
-            self.add_module('prelu', nn.modules.PReLU())
+            if activation == 'relu':  # the norm or dropout output isn't used elsewhere so can be overwritten
+                self.add_module('relu', nn.ReLU(inplace=True))
+            else:
+                self.add_module('prelu', nn.modules.PReLU())
+
+    def train(self, mode=True):
+        self._fusedParams = None  # parameters may change once out of eval mode so discard the folded values
+        return super(Convolution2D, self).train(mode)
+
+    def _apply(self, *args, **kwargs):
+        self._fusedParams = None  # device or dtype changes create new parameter tensors
+        return super(Convolution2D, self)._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._fusedParams = None  # loaded values replace those the folded parameters were computed from
+        return super(Convolution2D, self)._load_from_state_dict(*args, **kwargs)
+
+    def _getFusedParams(self):
+        '''
+        Returns the conv weight and bias with the batch norm statistics and affine parameters folded in, and whether the 
+        activation is ReLU or a PReLU with a zero slope everywhere. The values are cached and recomputed when any of the 
+        tensors they're derived from have been modified in place, as tracked by their version counters.
+        '''
+        conv, norm = self.conv, self.norm
+        sources = (conv.weight, conv.bias, norm.weight, norm.bias, norm.running_mean, norm.running_var,
+                   getattr(self[-1], 'weight', None))
+        versions = tuple(-1 if t is None else t._version for t in sources)
+
+        if self._fusedParams is None or self._fusedParams[0] != versions:
+            with torch.no_grad():
+                scale = torch.rsqrt(norm.running_var + norm.eps)
+                bias = -norm.running_mean * scale
+
+                if norm.affine:
+                    scale = scale * norm.weight
+                    bias = bias * norm.weight + norm.bias
+
+                if conv.bias is not None:
+                    bias = bias + conv.bias * scale
+
+                weight = conv.weight * scale.view(-1, 1, 1, 1)
+                isRelu = self.activation == 'relu' or bool((self.prelu.weight == 0).all())
+                isRelu = isRelu and hasattr(torch, 'cudnn_convolution_relu')
+
+            self._fusedParams = (versions, weight, bias, isRelu)
+
+        return self._fusedParams[1:]
+
+    def forward(self, x):
+        # folded parameters are computed without autograd so are only used when no gradients are needed
+        if self.training or torch.is_grad_enabled() or not self.canFuse or not self.norm.track_running_stats:
+            return super(Convolution2D, self).forward(x)
+
+        conv = self.conv
+        weight, bias, isRelu = self._getFusedParams()
+
+        # the cuDNN call isn't autocast aware so requires the input to already match the weight type
+        if isRelu and x.is_cuda and x.dtype == weight.dtype and not torch.is_autocast_enabled():
+            return torch.cudnn_convolution_relu(x, weight, bias, conv.stride, conv.padding, conv.dilation, conv.groups)
+
+        activation = self[-1]  # activation is always the last module when not convOnly
+        return activation(F.conv2d(x, weight, bias, conv.stride, conv.padding, conv.dilation, conv.groups))
 
 
 class ResidualUnit2D(nn.Module):
     def __init__(self, inChannels, outChannels, strides=1, kernelSize=3, subunits=2,
-                 instanceNorm=True, dropout=0, dilation=1, bias=True, lastConvOnly=False):
+                 instanceNorm=True, dropout=0, dilation=1, bias=True, lastConvOnly=False, activation='prelu'):
         super(ResidualUnit2D, self).__init__()
         self.inChannels = inChannels
         self.outChannels = outChannels
@@ -384,7 +466,7 @@ class ResidualUnit2D(nn.Module):
         for su in range(subunits):
             convOnly = lastConvOnly and su == (subunits - 1)
             unit = Convolution2D(schannels, outChannels, sstrides, kernelSize, instanceNorm, dropout, dilation, bias,
-                                 convOnly)
+                                 convOnly, activation=activation)
             self.conv.add_module('unit%i' % su, unit)
             schannels = outChannels  # after first loop set channels and strides to what they should be for subsequent units
             sstrides = 1
@@ -432,10 +514,24 @@ class DenseBlock(nn.Module):
             return Convolution2D(inChannels, outChannels, 1, self.kernelSize, self.instanceNorm, self.dropout, dilation)
 
     def forward(self, x):
-        cats = x
+        if torch.is_grad_enabled():
+            cats = x
+            for layer in self.children():
+                x = layer(cats)
+                cats = torch.cat([cats, x], 1)
+
+            return cats
+
+        # without autograd outputs can be written into one preallocated tensor instead of re-concatenating every layer,
+        # each layer reads the channels filled so far as a view of it
+        cats = x.new_empty((x.shape[0], self.outChannels) + tuple(x.shape[2:]))
+        numChannels = x.shape[1]
+        cats[:, :numChannels] = x
+
         for layer in self.children():
-            x = layer(cats)
-            cats = torch.cat([cats, x], 1)
+            x = layer(cats[:, :numChannels])
+            cats[:, numChannels:numChannels + x.shape[1]] = x
+            numChannels += x.shape[1]
 
         return cats
 
@@ -459,7 +555,7 @@ class Classifier(nn.Module):
         self.linear = None
         echannel = self.inChannels
 
-        self.finalSize = np.asarray([self.inHeight, self.inWidth], np.int)
+        self.finalSize = (self.inHeight, self.inWidth)
 
         # encode stage
         for i, (c, s) in enumerate(zip(self.channels, self.strides)):
@@ -468,7 +564,7 @@ class Classifier(nn.Module):
             self.classifier.add_module('layer_%i' % i, layer)
             self.finalSize = calculateOutShape(self.finalSize, kernelSize, s, samePadding(kernelSize))
 
-        self.linear = nn.Linear(int(np.product(self.finalSize)) * echannel, self.classes)
+        self.linear = nn.Linear(math.prod(self.finalSize) * echannel, self.classes)
 
     def _getLayer(self, inChannels, outChannels, strides, isLast):
         if self.numResUnits > 0:
@@ -642,7 +738,7 @@ class VarAutoEncoder(AutoEncoder):
 
         self.inHeight, self.inWidth, inChannels = inShape
         self.latentSize = latentSize
-        self.finalSize = np.asarray([self.inHeight, self.inWidth], np.int)
+        self.finalSize = (self.inHeight, self.inWidth)
 
         super().__init__(inChannels, outChannels, channels, strides, kernelSize, upKernelSize, numResUnits,
                          interChannels, interDilations, numInterUnits, instanceNorm, dropout)
@@ -650,7 +746,7 @@ class VarAutoEncoder(AutoEncoder):
         for s in strides:
             self.finalSize = calculateOutShape(self.finalSize, self.kernelSize, s, samePadding(self.kernelSize))
 
-        linearSize = int(np.product(self.finalSize)) * self.encodedChannels
+        linearSize = math.prod(self.finalSize) * self.encodedChannels
         self.mu = nn.Linear(linearSize, self.latentSize)
         self.logvar = nn.Linear(linearSize, self.latentSize)
         self.decodeL = nn.Linear(self.latentSize, linearSize)
@@ -685,6 +781,17 @@ class VarAutoEncoder(AutoEncoder):
         return self.decodeForward(z), mu, logvar, z
 
 
+def getSideStream(device):
+    '''Returns a Cuda stream for `device' other than the default stream, the same stream is returned for each device.'''
+    if device not in _sideStreams:
+        _sideStreams[device] = torch.cuda.Stream(device)
+
+    return _sideStreams[device]
+
+
+_sideStreams = {}  # kept outside modules since streams can't be pickled with a saved network
+
+
 class CycleEncoder(nn.Module):
     def __init__(self,a2bEncode,b2aEncode, noiseStd=1e-5):
         super().__init__()
@@ -698,10 +805,32 @@ class CycleEncoder(nn.Module):
     def b2aForward(self, x):
         return self.b2aEncode(x)[0]
 
+    def pairForward(self, xA, xB):
+        '''
+        Returns (b2aForward(xB), a2bForward(xA)). For Cuda inputs a2bForward() is run on a side stream while b2aForward()
+        runs on the current one so that the independent encoders can overlap on the GPU.
+        '''
+        if not xA.is_cuda:
+            return self.b2aForward(xB), self.a2bForward(xA)
+
+        current = torch.cuda.current_stream(xA.device)
+        side = getSideStream(xA.device)
+        side.wait_stream(current)  # xA must be computed before the side stream reads it
+
+        with torch.cuda.stream(side):
+            xA.record_stream(side)  # tell the allocator xA is in use on the side stream
+            outB = self.a2bForward(xA)
+
+        outA = self.b2aForward(xB)
+
+        current.wait_stream(side)
+        outB.record_stream(current)
+
+        return outA, outB
+
     def forward(self, imA, imB):
         # images produced by networks directly
-        outB = self.a2bForward(imA)
-        outA = self.b2aForward(imB)
+        outA, outB = self.pairForward(imA, imB)
 
         reconInA = outA
         reconInB = outB
@@ -712,8 +841,7 @@ class CycleEncoder(nn.Module):
             reconInB = addNormalNoise(reconInB, 0, self.noiseStd)
 
         # images reconstructed from passing network outputs through each other
-        reconA = self.b2aForward(reconInB)
-        reconB = self.a2bForward(reconInA)
+        reconA, reconB = self.pairForward(reconInA, reconInB)
 
         return outA, outB, reconA, reconB
 
@@ -763,6 +891,8 @@ class CycleEncoderPS(CycleEncoder):
 
 
 class SegnetAE(AutoEncoder):
+    trainPredictions = True  # set to False to skip computing predictions in train mode, None is returned in their place
+
     def __init__(self, inChannels, numClasses, channels, strides, kernelSize=3, upKernelSize=3,
                  numResUnits=0, interChannels=[], interDilations=[], numInterUnits=2, instanceNorm=True, dropout=0):
         super().__init__(inChannels, numClasses, channels, strides, kernelSize, upKernelSize,
@@ -770,7 +900,8 @@ class SegnetAE(AutoEncoder):
 
     def forward(self, x):
         x = super().forward(x)[0]
-        return x, predictSegmentation(x)
+        preds = predictSegmentation(x) if self.trainPredictions or not self.training else None
+        return x, preds
 
 
 class UnetBlock(nn.Module):
@@ -788,10 +919,14 @@ class UnetBlock(nn.Module):
 
 
 class Unet(nn.Module):
+    trainPredictions = True  # set to False to skip computing predictions in train mode, None is returned in their place
+
     def __init__(self, inChannels, numClasses, channels, strides, kernelSize=3,
-                 upKernelSize=3, numResUnits=0, instanceNorm=True, dropout=0):
+                 upKernelSize=3, numResUnits=0, instanceNorm=True, dropout=0, activation='prelu',
+                 upsampleMode='transpose'):
         super().__init__()
         assert len(channels) == (len(strides) + 1)
+        assert upsampleMode in ('transpose', 'nearest')
         self.inChannels = inChannels
         self.numClasses = numClasses
         self.channels = channels
@@ -801,6 +936,10 @@ class Unet(nn.Module):
         self.numResUnits = numResUnits
         self.instanceNorm = instanceNorm
         self.dropout = dropout
+        self.activation = activation
+        # 'nearest' upsamples then applies a stride 1 convolution, which avoids the slower transposed convolution
+        # algorithms and its checkerboard artifacts
+        self.upsampleMode = upsampleMode
 
         def _createBlock(inc, outc, channels, strides, isTop):
             c = channels[0]
@@ -822,30 +961,39 @@ class Unet(nn.Module):
 
     def _getDownLayer(self, inChannels, outChannels, strides, isTop):
         if self.numResUnits > 0:
-            return ResidualUnit2D(inChannels, outChannels, strides, self.kernelSize,
-                                  self.numResUnits, self.instanceNorm, self.dropout)
+            return ResidualUnit2D(inChannels, outChannels, strides, self.kernelSize, self.numResUnits,
+                                  self.instanceNorm, self.dropout, activation=self.activation)
         else:
-            return Convolution2D(inChannels, outChannels, strides, self.kernelSize, self.instanceNorm, self.dropout)
+            return Convolution2D(inChannels, outChannels, strides, self.kernelSize, self.instanceNorm, self.dropout,
+                                 activation=self.activation)
 
     def _getBottomLayer(self, inChannels, outChannels):
         return self._getDownLayer(inChannels, outChannels, 1, False)
 
     def _getUpLayer(self, inChannels, outChannels, strides, isTop):
-        conv = Convolution2D(inChannels, outChannels, strides, self.upKernelSize,
-                             self.instanceNorm, self.dropout, convOnly=isTop and self.numResUnits == 0,
-                             isTransposed=True)
+        convOnly = isTop and self.numResUnits == 0
+
+        if self.upsampleMode == 'nearest':
+            conv = nn.Sequential(nn.Upsample(scale_factor=strides, mode='nearest'),
+                                 Convolution2D(inChannels, outChannels, 1, self.upKernelSize, self.instanceNorm,
+                                               self.dropout, convOnly=convOnly, activation=self.activation)
+                                 )
+        else:
+            conv = Convolution2D(inChannels, outChannels, strides, self.upKernelSize, self.instanceNorm, self.dropout,
+                                 convOnly=convOnly, isTransposed=True, activation=self.activation)
 
         if self.numResUnits > 0:
             return nn.Sequential(conv,
                                  ResidualUnit2D(outChannels, outChannels, 1, self.kernelSize, 1, self.instanceNorm,
-                                                self.dropout, lastConvOnly=isTop)
+                                                self.dropout, lastConvOnly=isTop, activation=self.activation)
                                  )
         else:
             return conv
 
     def forward(self, x):
         x = self.model(x)
-        return x, predictSegmentation(x)
+        preds = predictSegmentation(x) if self.trainPredictions or not self.training else None
+        return x, preds
 
 
 ########################################################################################################################
@@ -937,6 +1085,28 @@ class TestConvolution2D(ImageTestCase):
         expectedShape = (1, self.outputChannels, self.inShape[0] * 2, self.inShape[1] * 2)
         self.assertEqual(out.shape, expectedShape)
 
+    def test_relu1(self):
+        conv = Convolution2D(self.inputChannels,self.outputChannels, activation='relu')
+        out = conv(self.imT)
+        expectedShape = (1, self.outputChannels, self.inShape[0], self.inShape[1])
+        self.assertEqual(out.shape, expectedShape)
+        self.assertGreaterEqual(out.min().item(), 0)
+
+    def test_fusedEval1(self):
+        conv = Convolution2D(self.inputChannels,self.outputChannels, instanceNorm=False)
+        conv(self.imT)  # update the batch norm running statistics
+        conv.eval()
+        with torch.no_grad():
+            out = conv(self.imT)
+            expected = nn.Sequential.forward(conv, self.imT)
+        self.assertTrue(torch.allclose(out, expected, atol=1e-5))
+
+    def test_evalGrad1(self):
+        conv = Convolution2D(self.inputChannels,self.outputChannels, instanceNorm=False)
+        conv.eval()
+        conv(self.imT).sum().backward()  # with gradients enabled the unfolded modules must be used
+        self.assertIsNotNone(conv.conv.weight.grad)
+
 
 class TestResidualUnit2D(ImageTestCase):
     def test_convOnly1(self):
@@ -1005,6 +1175,27 @@ class TestUnet(ImageTestCase):
         self.assertEqual(out[0].shape, self.seg1hot.shape)
         self.assertEqual(out[1].shape, outShape)
 
+    def test_nearest1(self):
+        net = Unet(1, self.numClasses + 1, [4, 8, 16], [2, 2], upsampleMode='nearest')
+        out = net(self.imT)
+        self.assertEqual(out[0].shape, self.seg1hot.shape)
+
+    def test_scriptBatchNorm1(self):
+        net = Unet(1, self.numClasses + 1, [4, 8, 16], [2, 2], instanceNorm=False)
+        net(self.imT)  # update the batch norm running statistics
+        scripted = scriptForInference(net, self.imT)
+        with torch.no_grad():
+            out = scripted(self.imT)
+            expected = net(self.imT)
+        self.assertTrue(torch.allclose(out[0], expected[0], atol=1e-4))
+
+    def test_noTrainPredictions1(self):
+        net = Unet(1, 1, [4, 8, 16], [2, 2])
+        net.trainPredictions = False
+        self.assertIsNone(net(self.imT)[1])
+        net.eval()
+        self.assertEqual(net(self.imT)[1].dtype, torch.uint8)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -8,6 +8,7 @@ import glob
 import time
 import datetime
 import threading
+import contextlib
 
 import torch
 import pytorchnet
@@ -87,10 +88,14 @@ class NetworkManager(object):
         If `isCuda' is True the network and inputs are converted to cuda tensors. The `saveDirPrefix' is the prefix for
         the new directory to create if it doesn't exist, if it does exist it is expected to be a previously created
         directory with a stored network that is reloaded. The `params' value is a user parameter dict for the network.
+        When using Cuda, if params['channelsLast'] is True the network and 4D inputs use the channels last memory format,
+        and if params['amp'] is True training and evaluation use automatic mixed precision with a gradient scaler. Mixed
+        precision is applied by the default trainStep() and by evaluate(), subtypes overriding trainStep() must use
+        self.autocast(), self.floatOutputs(), and self.scaler (None if mixed precision isn't used) themselves to do so.
         '''
         self.net=net
         self.isCuda=isCuda
-        self.device=torch.device('cuda' if isCuda and torch.cuda.is_available else 'cpu')
+        self.device=torch.device('cuda' if isCuda and torch.cuda.is_available() else 'cpu')
         self.params=params
         self.opt=opt
         self.loss=loss
@@ -101,15 +106,24 @@ class NetworkManager(object):
         self.isRunning=True
         self.lock=threading.RLock()
         
+        isCudaDevice=self.device.type=='cuda'
+        self.channelsLast=params.get('channelsLast',False) and isCudaDevice # NHWC is needed for Tensor Core convs
+        self.useAmp=params.get('amp',False) and isCudaDevice
+        self.scaler=torch.amp.GradScaler('cuda') if self.useAmp else None
+        
         self.savedir=None
         self.savePrefix=savePrefix
         self.doLog=True
+        self.logfile=None
+        self.inputBuffers={} # (slot,index) -> (pinned host tensor, device tensor) used by train() with Cuda
+        self.bufferSlot=0
         
         if isCuda and torch.cuda.is_available():
             torch.cuda.empty_cache()
+            torch.backends.cudnn.benchmark=True # input sizes are fixed per batch so let cuDNN choose the fastest algorithms
             
         if self.net is not None:
-            self.net=self.net.to(self.device)
+            self.net=self.toDevice(self.net)
             
         if self.opt is None and self.net is not None:
             lr=params.get('learningRate',1e-3)
@@ -152,10 +166,11 @@ class NetworkManager(object):
     
     def evalStep(self,index,steploss,results):
         '''
-        Called after every evaluation step, with arguments for the step number and loss at that step. The `results' list
-        is the accumulated result from each application of this method. Given self.traininputs and self.netoutputs this
-        method is expected to calculate some evaluation result or metric from these and append it to `results'. The
-        default implementation simply appends self.netoutputs to `results'.
+        Called after every evaluation step, with arguments for the step number and loss at that step. The loss is given as
+        a 0-dim tensor on the network's device so that evaluation doesn't wait for each step, use item() to get the value
+        if needed. The `results' list is the accumulated result from each application of this method. Given 
+        self.traininputs and self.netoutputs this method is expected to calculate some evaluation result or metric from
+        these and append it to `results'. The default implementation simply appends self.netoutputs to `results'.
         '''
         results.append(self.netoutputs)
     
@@ -182,14 +197,28 @@ class NetworkManager(object):
         return os.path.join(self.savedir,'%s_train.log'%(self.savePrefix,))
                 
     def log(self,*items):
-        '''Log the given values to getLogFilename().'''
+        '''
+        Log the given values to getLogFilename(). The file is kept open between calls, line buffered so that each message
+        is written immediately, and is reopened if the filename changes.
+        '''
         if self.doLog:
             dt=datetime.datetime.now().strftime('%Y%m%d-%H:%M:%S: ')
             msg=dt+' '.join(map(str,items))
             
             if self.savedir:
-                with open(self.getLogFilename(),'a') as o:
-                    print(msg,file=o)
+                filename=self.getLogFilename()
+                
+                if self.logfile is None or self.logfile.name!=filename:
+                    self.closeLog()
+                    self.logfile=open(filename,'a',buffering=1)
+                    
+                print(msg,file=self.logfile)
+                
+    def closeLog(self):
+        '''Close the log file if open, the next call to log() will reopen it.'''
+        if self.logfile is not None:
+            self.logfile.close()
+            self.logfile=None
     
     def reload(self,prefix=None):
         '''Reload the network state by loading the most recent .pth file in the save directory if there is one.'''
@@ -212,7 +241,7 @@ class NetworkManager(object):
         state=torch.load(path,map_location='cpu')
         self.net=state.pop('__net__')
         self.net.load_state_dict(state)
-        self.net=self.net.to(self.device) # ensure the hardware state of the loaded network matches what's requested
+        self.net=self.toDevice(self.net) # ensure the hardware state of the loaded network matches what's requested
         
     def saveNet(self,path):
         '''Save the network and its state to the given path by adding the network as "__net__" to the state dict.'''
@@ -225,12 +254,91 @@ class NetworkManager(object):
         for p in self.net.parameters():
             p.requires_grad=grad
         
+    def toDevice(self,net):
+        '''Move `net' to the selected device, converting it to channels last format if self.channelsLast is True.'''
+        net=net.to(self.device)
+        
+        if self.channelsLast:
+            net=net.to(memory_format=torch.channels_last)
+            
+        return net
+    
+    def autocast(self):
+        '''Returns the mixed precision autocast context for forward passes, this is a no-op if self.useAmp is False.'''
+        if self.useAmp:
+            return torch.amp.autocast('cuda')
+        
+        return contextlib.suppress() # empty context since nullcontext isn't present in older versions
+    
+    def floatOutputs(self,outputs):
+        '''
+        Returns `outputs', a tensor or a list/tuple of values, with reduced precision floating point tensors converted to
+        float32. This is used with mixed precision so that losses are computed outside autocast in full precision.
+        '''
+        if isinstance(outputs,(list,tuple)):
+            return type(outputs)(map(self.floatOutputs,outputs))
+        elif isinstance(outputs,torch.Tensor) and outputs.is_floating_point() and outputs.dtype!=torch.float32:
+            return outputs.float()
+        
+        return outputs
+        
     def convertArray(self,arr):
-        '''Convert the Numpy array `arr' to a PyTorch tensor, converting to Cuda if necessary.'''
+        '''
+        Convert the Numpy array `arr' to a PyTorch tensor, converting to Cuda if necessary. Cuda transfers are done from
+        pinned memory without blocking so the copy is only ordered with respect to the current stream.
+        '''
         if not isinstance(arr,torch.Tensor):
             arr=torch.from_numpy(arr)
+            
+        if self.device.type=='cuda' and not arr.is_cuda:
+            arr=arr.pin_memory().to(self.device,non_blocking=True)
+        else:
+            arr=arr.to(self.device)
+            
+        if self.channelsLast and arr.dim()==4:
+            arr=arr.contiguous(memory_format=torch.channels_last)
+        
+        return arr
+    
+    def convertArrayBuffered(self,arr,index):
+        '''
+        Convert the Numpy array `arr' to a Cuda tensor like convertArray() but by copying through persistent pinned host
+        and device buffers for input `index' in the current buffer slot, which are only reallocated if the shape or type
+        of `arr' changes. The returned tensor is overwritten when the slot is next used.
+        '''
+        if isinstance(arr,torch.Tensor):
+            return self.convertArray(arr)
         
-        return arr.to(self.device)
+        key=(self.bufferSlot,index)
+        pinned,buffer=self.inputBuffers.get(key,(None,None))
+        
+        if pinned is None or pinned.shape!=arr.shape or pinned.numpy().dtype!=arr.dtype:
+            pinned=torch.from_numpy(np.empty_like(arr)).pin_memory()
+            memformat=torch.channels_last if self.channelsLast and arr.ndim==4 else torch.contiguous_format
+            buffer=torch.empty(pinned.shape,dtype=pinned.dtype,device=self.device,memory_format=memformat)
+            self.inputBuffers[key]=(pinned,buffer)
+            
+        np.copyto(pinned.numpy(),arr) # copies from any strided layout without an intermediate tensor
+        buffer.copy_(pinned,non_blocking=True)
+        
+        return buffer
+    
+    def prefetchInputs(self,inputfunc,stream=None):
+        '''
+        Call `inputfunc' and convert each of its returned arrays with convertArray(). If `stream' is a Cuda stream the
+        transfers are queued on it, returning the list of tensors and an event recorded after the transfers which must
+        be waited on before using them, otherwise the event is None. With a stream, arrays are copied into persistent
+        buffers alternating between two slots so that one step's inputs can be filled while the previous step computes.
+        '''
+        if stream is None:
+            return [self.convertArray(arr) for arr in inputfunc()],None
+        
+        self.bufferSlot=1-self.bufferSlot
+        
+        with torch.cuda.stream(stream):
+            inputs=[self.convertArrayBuffered(arr,i) for i,arr in enumerate(inputfunc())]
+            
+        return inputs,stream.record_event()
     
     def toNumpy(self,arr):
         '''Convert the PyTorch Tensor `arr' to a Numpy array.'''
@@ -240,22 +348,36 @@ class NetworkManager(object):
         '''
         Implements the basic training sequence for `numSubsteps' number of times. Each sequence is composed of running
         the network forward, running the loss function forward, zeroing optimizer gradients, feeding the loss result
-        backward, and stepping the optimizer.
+        backward, and stepping the optimizer. With mixed precision the network forward pass runs under autocast, the loss
+        is computed in full precision and scaled before the backward pass by self.scaler, which then unscales the 
+        gradients when stepping the optimizer.
         '''
         for sub in range(numSubsteps):
-            self.netoutputs=self.netForward()
+            with self.autocast():
+                self.netoutputs=self.netForward()
+                
+            self.netoutputs=self.floatOutputs(self.netoutputs)
             self.lossoutput=self.lossForward()
             
             self.opt.zero_grad()
-            self.lossoutput.backward()
-            self.opt.step()
+            
+            if self.scaler is None:
+                self.lossoutput.backward()
+                self.opt.step()
+            else:
+                self.scaler.scale(self.lossoutput).backward()
+                self.scaler.step(self.opt)
+                self.scaler.update()
 
     def train(self,inputfunc,steps,substeps=1,savesteps=5):
         '''
         Train the network for `step' number of steps starting at 1, saving `savesteps' number of times at regular 
         intervals. The callable `inputfunc' is expected to take no arguments and return a tuple pf batch Numpy arrays of 
         shape, B, BC, BCHW or BCDHW. A train step is composed of these steps:
-            1. `inputfunc' is called, each returned value is converted to a tensor, then tuple of all assigned to self.traininputs
+            1. `inputfunc' is called, each returned value is converted to a tensor, then tuple of all assigned to self.traininputs,
+               with Cuda the next step's inputs are fetched and transferred on a separate stream while this step computes
+               (otherwise inputs are fetched at the start of each step),
+               these tensors are reused buffers so must be copied if they are needed beyond the following step
             2. trainStep() is called which is expected to do the following for `substeps' number of times:
               a. self.netForward() is called and results assigned to self.netoutputs
               b. self.lossForward() is called and results assigned to self.lossoutput
@@ -278,14 +400,34 @@ class NetworkManager(object):
             
             if self.net is not None:
                 self.net.train()
+                
+            copyStream=torch.cuda.Stream(self.device) if self.device.type=='cuda' else None
+            nextinputs=self.prefetchInputs(inputfunc,copyStream) if copyStream is not None else None
             
             for s in range(1,steps+1):
                 self.log('Timestep',s,'/',steps)
                 self.step+=1
                 
                 with self.lock:
-                    self.traininputs=[self.convertArray(arr) for arr in inputfunc()] 
+                    # without a copy stream inputs are fetched here since CPU tensors share memory with the batch arrays
+                    if copyStream is None:
+                        nextinputs=self.prefetchInputs(inputfunc)
+                        
+                    self.traininputs,copied=nextinputs
+                    
+                    if copied is not None:
+                        curStream=torch.cuda.current_stream(self.device)
+                        curStream.wait_event(copied)
+                        # tensors were allocated on the copy stream, tell the allocator they're used on this one
+                        for t in self.traininputs:
+                            t.record_stream(curStream)
+                    
                     self.trainStep(substeps)
+                    
+                    # fetch the next inputs while the queued step computes, before item() waits for it to finish,
+                    # these are copied into separate buffers so self.traininputs is unaffected 
+                    if copyStream is not None and s<steps:
+                        nextinputs=self.prefetchInputs(inputfunc,copyStream)
                 
                     lossval=self.lossoutput.item()
                     self.log('Loss:',lossval)
@@ -305,6 +447,7 @@ class NetworkManager(object):
             self.log('Total time (s): %s'%(time.time()-start))
             self.log('Params:',self.params)
             self.log('===================================Done===================================')
+            self.closeLog()
 
     def evaluate(self,inputs,batchSize=2):
         '''
@@ -317,31 +460,44 @@ class NetworkManager(object):
             3. self.lossForward() is called and results assigned to self.lossoutput
             4. Call self.evalStep()
             5. Clear the stored variables to free the graph
+            
+        Loss values are kept on the device until all batches are done and then copied to the host together.
         '''
         self.log('================================Evaluating================================')
         start=time.time()
+        # inference mode (when present) additionally skips autograd's version counting and view tracking
+        inferenceMode=getattr(torch,'inference_mode',torch.no_grad)
         
         try:
             inputlen=inputs[0].shape[0]
             losses=[]
+            lossTensors=[]
             results=[]
             
             if self.net is not None:
                 self.net.eval()
             
-            with torch.no_grad():
+            with inferenceMode():
                 for i in range(0,inputlen,batchSize):
                     with self.lock:
                         self.traininputs=[self.convertArray(arr[i:i+batchSize]) for arr in inputs]
-                        self.netoutputs=self.netForward()
+                        
+                        with self.autocast():
+                            self.netoutputs=self.netForward()
+                            
+                        self.netoutputs=self.floatOutputs(self.netoutputs)
                         self.lossoutput=self.lossForward()
-                        losses.append(self.lossoutput.item())
+                            
+                        lossTensors.append(self.lossoutput.detach())
     
-                        self.evalStep(i,losses[-1],results)
+                        self.evalStep(i,lossTensors[-1],results)
                         # clear stored variables to free graph
                         self.traininputs=None
                         self.netoutputs=None
                         self.lossoutput=None
+                        
+            if lossTensors:
+                losses=torch.stack(lossTensors).cpu().tolist() # one host sync for every batch's loss
                 
         except Exception as e:
             self.log(e)
@@ -353,13 +509,16 @@ class NetworkManager(object):
             self.log('Total time (s): %s'%(time.time()-start))
             self.log('Losses:',losses)
             self.log('===================================Done===================================')
+            self.closeLog()
             
         return losses,results
     
-    def infer(self,inputs,batchSize=2):
+    def infer(self,inputs,batchSize=2,traceNet=False):
         '''
         Infer results by applying it to batches of size `batchSize' from the input arrays given in `inputs'. This only 
-        uses the forward pass of the network to compute output and does not compute loss or use the optimizer:
+        uses the forward pass of the network to compute output and does not compute loss or use the optimizer. If
+        `traceNet' is True self.net is replaced during inference with a TorchScript version traced from the first input 
+        of the first batch, so this should only be used if netForward() applies the first input to self.net alone:
             1. Convert each batch slice of arrays in `inputs' to tensors and store all in self.traininputs
             2. self.netForward() is called and results assigned to self.netoutputs
             3. If self.netoutputs is a list or tuple, each tensor it stores is converted to Numpy and appended to the 
@@ -371,6 +530,7 @@ class NetworkManager(object):
         assert all(i.shape[0]==inputs[0].shape[0] for i in inputs)
         inputlen=inputs[0].shape[0]
         results=[]
+        net=self.net
         
         try:
             if self.net is not None:
@@ -380,6 +540,10 @@ class NetworkManager(object):
                 for i in range(0,inputlen,batchSize):
                     with self.lock:
                         self.traininputs=[self.convertArray(arr[i:i+batchSize]) for arr in inputs]
+                        
+                        if traceNet and net is not None and self.net is net:
+                            self.net=pytorchnet.scriptForInference(net,self.traininputs[0])
+                            
                         self.netoutputs=self.netForward()
     
                         if isinstance(self.netoutputs,(tuple,list)):
@@ -392,6 +556,7 @@ class NetworkManager(object):
 
             return results
         finally:
+            self.net=net
             if self.net is not None:
                 self.net.train()
     
@@ -1,6 +1,7 @@
 # DeepLearnUtils 
 # Copyright (c) 2017-8 Eric Kerfoot, KCL, see LICENSE file
 
+import math
 import tensorflow as tf
 import tensorflow.nn as nn
 import tensorflow.keras as tfk
@@ -15,9 +16,10 @@ def predictSegmentation(logits):
     '''
     # generate prediction outputs, logits has shape BHW[D]C
     if logits.shape[-1] == 1:
-        return tf.cast(logits[..., 0] >= 0, tf.int32)  # for binary segmentation threshold on channel 0
+        # for binary segmentation threshold on channel 0, logit 0 is probability 0.5 so no sigmoid is needed
+        return tf.cast(logits[..., 0] >= 0, tf.uint8)
     else:
-        return tf.argmax(logits, logits.ndim - 1)  # take the index of the max value along dimension 1
+        return tf.argmax(logits, -1)  # take the index of the max value along the channel dimension
 
 
 class DiceLoss(tfk.losses.Loss):
@@ -226,7 +228,7 @@ class VarAutoEncoder(AutoEncoder):
 
         self.inHeight, self.inWidth, inChannels = inShape
         self.latentSize = latentSize
-        self.finalSize = np.asarray([self.inHeight, self.inWidth], np.int)
+        self.finalSize = (self.inHeight, self.inWidth)
 
         super().__init__(inChannels, outChannels, channels, strides, kernelSize, upKernelSize, numResUnits,
                          interChannels, interDilations, numInterUnits, instanceNorm, dropout)
@@ -234,7 +236,7 @@ class VarAutoEncoder(AutoEncoder):
         for s in strides:
             self.finalSize = calculateOutShape(self.finalSize, self.kernelSize, s, samePadding(self.kernelSize))
 
-        linearSize = int(np.product(self.finalSize)) * self.encodedChannels
+        linearSize = math.prod(self.finalSize) * self.encodedChannels
         self.mu = tfk.layers.Dense(self.latentSize)
         self.logvar = tfk.layers.Dense(self.latentSize)
         self.decodeL = tfk.layers.Dense(linearSize)
@@ -284,6 +286,8 @@ class UnetBlock(tfk.Model):
 
 
 class Unet(tfk.Model):
+    trainPredictions = True  # set to False to skip computing predictions in train mode, None is returned in their place
+
     def __init__(self, inChannels, numClasses, channels, strides, kernelSize=3,
                  upKernelSize=3, numResUnits=0, instanceNorm=True, dropout=0):
         super().__init__()
@@ -336,9 +340,10 @@ class Unet(tfk.Model):
         else:
             return conv
 
-    def call(self, x):
+    def call(self, x, training=None):
         x = self.model(x)
-        return x, predictSegmentation(x)
+        preds = predictSegmentation(x) if self.trainPredictions or not training else None
+        return x, preds
 
 
 ########################################################################################################################
@@ -505,6 +510,12 @@ class TestUnet(ImageTestCase):
         self.assertEqual(out[0].shape, self.seg1hot.shape)
         self.assertEqual(out[1].shape, self.imT.shape[:-1])
 
+    def test_noTrainPredictions1(self):
+        net = Unet(1, 1, [4, 8, 16], [2, 2])
+        net.trainPredictions = False
+        self.assertIsNone(net(self.imT, training=True)[1])
+        self.assertEqual(net(self.imT, training=False)[1].dtype, tf.uint8)
+
 
 if __name__ == '__main__':
     unittest.main()
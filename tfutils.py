@@ -9,6 +9,7 @@ import os
 import datetime
 import collections
 import threading
+import atexit
 
 try:
     import queue
@@ -24,11 +25,10 @@ def averageGradients(tower_grads):
     avggrads = []
     # each grad_and_vars looks like ((grad0_gpu0, var0_gpu0), ... , (grad0_gpuN, var0_gpuN))
     for grad_and_vars in zip(*tower_grads):
-        grads=[tf.expand_dims(g, 0) for g,_ in grad_and_vars if g is not None]
+        grads=[g for g,_ in grad_and_vars if g is not None]
         assert len(grads)>0, 'No variables have gradients'
         
-        grad=tf.concat(grads,0)
-        grad=tf.reduce_mean(grad, 0) 
+        grad=tf.add_n(grads)*(1.0/len(grads)) # sums without stacking the tower gradients into one tensor first
 
         # variables are shared across towers, need only return first tower's variable refs
         avggrads.append((grad,grad_and_vars[0][1]))
@@ -37,20 +37,80 @@ def averageGradients(tower_grads):
 
 def binaryMaskDiceLoss(logits, labels, smooth=1e-5):
     '''Return the binary mask dice loss between the given logits and labels.'''
-    axis = list(range(1, logits.shape.ndims - 1)) # for BWHC sum over WH
     logits=tf.cast(logits,tf.float32)
     labels=tf.cast(labels,tf.float32)
 
-    probs = tf.nn.sigmoid(logits)[..., 0]
-    label_sum = tf.reduce_sum(labels, axis=axis, name='label_sum')
-    pred_sum = tf.reduce_sum(probs, axis=axis, name='pred_sum')
-    intersection = tf.reduce_sum(labels * probs, axis=axis, name='intersection')
-    sums=label_sum + pred_sum
+    # flatten BWHC logits and BWH labels to BN so each sum is a single reduction over the last axis
+    batchsize=tf.shape(logits)[0]
+    probs = tf.reshape(tf.nn.sigmoid(logits)[..., 0],[batchsize,-1])
+    labels = tf.reshape(labels,[batchsize,-1])
+    
+    intersection = tf.einsum('bn,bn->b', labels, probs, name='intersection')
+    sums = tf.reduce_sum(labels + probs, axis=1, name='sums') # one reduction for the label and prediction sums
 
     dice = tf.reduce_mean((2.0 * intersection + smooth) / (sums + smooth))
     return 1.0-dice
 
 
+def addImageSummaries(images):
+    '''
+    Add an image summary for each tensor in the name->image dict `images', which are HW or HWC tensors. Dimensions are
+    added with expand_dims rather than reshaping to a computed shape so no copy is needed for strided inputs.
+    '''
+    for name, image in images.items():
+        if len(image.shape)<3:
+            image=tf.expand_dims(image,-1)
+            
+        tf.summary.image(name, tf.expand_dims(image,0))
+        
+
+class LogWriter(threading.Thread):
+    '''
+    Daemon thread appending the messages passed to write() to the file `filename' as lines. The thread blocks on its
+    queue until a message arrives and keeps the file open between writes. Messages are held until the directory of
+    the file exists, as the estimator creates its model directory only once training starts. Remaining messages are
+    written when close() is called, which happens at exit if not done before.
+    '''
+    def __init__(self,filename):
+        threading.Thread.__init__(self)
+        self.daemon=True
+        self.filename=filename
+        self.queue=queue.Queue()
+        self.start()
+        atexit.register(self.close)
+        
+    def write(self,msg):
+        self.queue.put(msg)
+        
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None) # sentinel stopping the thread
+            self.join()
+        
+    def run(self):
+        pending=[]
+        out=None
+        
+        try:
+            while True:
+                msg=self.queue.get()
+                if msg is not None:
+                    pending.append(msg)
+                
+                if pending and out is None and os.path.isdir(os.path.dirname(self.filename) or '.'):
+                    out=open(self.filename,'a',buffering=1) # line buffered so each message is flushed 
+                    
+                if out is not None and pending:
+                    out.write('\n'.join(pending)+'\n')
+                    pending=[]
+                    
+                if msg is None: # exit after writing held messages if the directory now exists
+                    break
+        finally:
+            if out is not None:
+                out.close()
+                
+
 class GraphImageHook(tf.train.SessionRunHook):
     '''
     This hook keeps track of the nominated scalar and image values. This is used to output graphed histories of the scalars
@@ -62,6 +122,7 @@ class GraphImageHook(tf.train.SessionRunHook):
         self.imagenames=imagenames
         self.avgLength=50
         self.graphvalues=collections.OrderedDict([(n,[]) for n in graphnames]+[(n+' Avg',[]) for n in graphnames])
+        self.avgWindows={} # name -> (deque of the last avgLength values, sum of those values)
         self.images={}
         
     def before_run(self, run_context):
@@ -73,8 +134,19 @@ class GraphImageHook(tf.train.SessionRunHook):
         for n in self.graphnames:
             v=res[n]
             self.graphvalues[n].append(v)
-            rollingAvg=np.average(self.graphvalues[n][-self.avgLength:])
-            self.graphvalues[n+' Avg'].append(rollingAvg)
+            
+            window,total=self.avgWindows.get(n,(None,0.0))
+            if window is None or window.maxlen!=self.avgLength:
+                window=collections.deque(self.graphvalues[n][-self.avgLength:],maxlen=self.avgLength)
+                total=float(np.sum(window))
+            else:
+                if len(window)==window.maxlen:
+                    total-=window[0] # oldest value is dropped by the append below
+                window.append(v)
+                total+=v
+                
+            self.avgWindows[n]=(window,total)
+            self.graphvalues[n+' Avg'].append(total/len(window))
             
         self.images=collections.OrderedDict((n,res[n]) for n in self.imagenames)
         self.update()
@@ -94,7 +166,7 @@ class BaseEstimator(tf.estimator.Estimator):
         self.summaries={}
         
         self.logfilename='train.log'
-        self.logqueue=[]
+        self.logwriter=None
 
         if savedirprefix:
             if os.path.exists(savedirprefix):
@@ -107,12 +179,12 @@ class BaseEstimator(tf.estimator.Estimator):
     def log(self,*items):
         dt=datetime.datetime.now().strftime('%Y%m%d-%H:%M:%S: ')
         msg=dt+' '.join(map(str,items))
-        self.logqueue.append(msg)
         
-        if os.path.isdir(self.savedir):
-            with open(os.path.join(self.savedir,self.logfilename),'a') as o:
-                o.write('\n'.join(self.logqueue)+'\n')
-            self.logqueue=[]
+        if self.savedir:
+            if self.logwriter is None:
+                self.logwriter=LogWriter(os.path.join(self.savedir,self.logfilename))
+                
+            self.logwriter.write(msg)
 
     def _modelfn(self,features, labels, mode, params):
 
@@ -130,9 +202,7 @@ class BaseEstimator(tf.estimator.Estimator):
 
                 self.createSummaries(mode,params)
                 
-                for name, image in self.summaries.items():
-                    shape=[1,image.shape[0],image.shape[1],1 if len(image.shape)<3 else image.shape[2]]
-                    tf.summary.image(name, tf.reshape(image, shape))
+                addImageSummaries(self.summaries)
             
                 self.summaries['loss']=self.loss
                 tf.summary.scalar('loss',self.loss)
@@ -166,7 +236,7 @@ class BinarySegmentNN(tf.estimator.Estimator):
         self.summaries={}
         
         self.logfilename='train.log'
-        self.logqueue=[]
+        self.logwriter=None
 
         if savedirprefix:
             if os.path.exists(savedirprefix):
@@ -179,12 +249,12 @@ class BinarySegmentNN(tf.estimator.Estimator):
     def log(self,*items):
         dt=datetime.datetime.now().strftime('%Y%m%d-%H:%M:%S: ')
         msg=dt+' '.join(map(str,items))
-        self.logqueue.append(msg)
         
-        if os.path.isdir(self.savedir):
-            with open(os.path.join(self.savedir,self.logfilename),'a') as o:
-                o.write('\n'.join(self.logqueue)+'\n')
-            self.logqueue=[]
+        if self.savedir:
+            if self.logwriter is None:
+                self.logwriter=LogWriter(os.path.join(self.savedir,self.logfilename))
+                
+            self.logwriter.write(msg)
 
     def _modelfn(self,features, labels, mode, params):
         global_step = tf.train.get_global_step()
@@ -223,9 +293,7 @@ class BinarySegmentNN(tf.estimator.Estimator):
                 self.summaries['logits'] = self.logits[0, ..., :, :,0]
                 self.summaries['preds'] = tf.cast(self.preds, tf.float32)[0, ..., :, :]
                 
-                for name, image in self.summaries.items():
-                    shape=[1,image.shape[0],image.shape[1],1 if len(image.shape)<3 else image.shape[2]]
-                    tf.summary.image(name, tf.reshape(image, shape))
+                addImageSummaries(self.summaries)
             
                 self.summaries['loss']=self.loss
                 tf.summary.scalar('loss',self.loss)
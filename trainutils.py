@@ -3,15 +3,22 @@
 
 
 from __future__ import division, print_function
-import subprocess, re, time, platform, threading, random, contextlib
+import subprocess, re, time, platform, threading, random, contextlib, os
 from collections import OrderedDict
 from itertools import product, starmap
+from functools import lru_cache
 import inspect
 import numpy as np
 
 import scipy.spatial
 from scipy.ndimage import label, binary_fill_holes, maximum_filter, sum as ndsum
 
+try:
+    from numba import njit
+    numbaAvailable=True
+except ImportError:
+    numbaAvailable=False
+
 #import matplotlib.pyplot as plt
 #from matplotlib.ticker import MaxNLocator
 #import matplotlib.animation as animation
@@ -43,6 +50,50 @@ def randChoice(prob=0.5):
     return random.random()<=prob
 
 
+class RandomBuffer(threading.local):
+    '''
+    Thread-local source of random values which draws `size' uniform values at a time, amortizing generator overhead over
+    many scalar draws. Values are drawn from np.random so that np.random.seed() reproduces them like other augments,
+    but values already buffered are still used after seeding so call seed() after np.random.seed() to discard them. In
+    forked subprocesses a generator seeded from np.random and the process ID is used instead so that these don't repeat
+    the values of their parent or each other.
+    '''
+    def __init__(self,size=4096):
+        self.size=size
+        self.pid=None
+        self.rng=None
+        self.values=[]
+        self.pos=0
+        
+    def seed(self):
+        '''Discard this thread's buffered values so that its next values come from the current state of np.random.'''
+        self.pid=None
+        self.pos=len(self.values)
+        
+    def random(self):
+        '''Returns a random float value in [0,1).'''
+        if self.pid!=os.getpid():
+            self.pid=os.getpid()
+            forked=self.pid!=_mainPid
+            self.rng=np.random.default_rng([np.random.randint(2**31),self.pid]) if forked else np.random
+            self.pos=len(self.values)
+            
+        if self.pos>=len(self.values):
+            self.values=self.rng.random(self.size).tolist()
+            self.pos=0
+            
+        self.pos+=1
+        return self.values[self.pos-1]
+    
+    def randint(self,low,high):
+        '''Returns a random integer from `low' inclusive to `high' exclusive.'''
+        return low+int(self.random()*(high-low))
+    
+    
+_mainPid=os.getpid() # process the module was imported in, differs in forked subprocesses
+randomBuffer=RandomBuffer()
+    
+
 def imgBounds(img):
     '''Returns the minimum and maximum indices of non-zero lines in axis 0 of `img', followed by that for axis 1.'''
     ax0 = np.any(img, axis=0)
@@ -68,6 +119,9 @@ def ensureTupleSize(tup,dim):
 
 def zeroMargins(img,margin):
     '''Returns True if the values within `margin' indices of the edges of `img' are 0.'''
+    if numbaAvailable and margin>0:
+        return _zeroMarginsJit(img.reshape(img.shape[:2]+(-1,)),margin)
+    
     if np.any(img[:,:margin]) or np.any(img[:,-margin:]):
         return False
     
@@ -77,15 +131,114 @@ def zeroMargins(img,margin):
     return True
 
 
+def minMax(arr):
+    '''Returns the minimum and maximum values of `arr', computed in a single pass if Numba is available.'''
+    if numbaAvailable and arr.size>0:
+        return _minMaxJit(arr.ravel())
+    
+    return np.min(arr),np.max(arr)
+
+
+def flipRescaleBatch(arr,flipCodes):
+    '''
+    Returns a float32 array with each item of the batch `arr' flipped according to the matching value in `flipCodes'
+    (0 for no flip, 1 for left-right, 2 for up-down) then rescaled to [0,1] as rescaleArray does. If Numba is available
+    this is done in one compiled pass over the data for each item.
+    '''
+    flipCodes=np.asarray(flipCodes)
+    
+    if numbaAvailable and arr.ndim>=3:
+        out=np.empty(arr.shape,np.float32)
+        dims=arr.shape[:3]+(-1,) # collapse channel dimensions so the kernel only deals with 4D arrays
+        _flipRescaleBatchJit(arr.reshape(dims),flipCodes,out.reshape(dims))
+        return out
+    
+    out=arr.astype(np.float32)
+    lr=flipCodes==1
+    ud=flipCodes==2
+    out[lr]=out[lr,:,::-1]
+    out[ud]=out[ud,::-1]
+    
+    return rescaleInstanceArray(out)
+
+
+if numbaAvailable:
+    @njit(cache=True)
+    def _anyNonzero(img,y0,y1,x0,x1):
+        for i in range(y0,y1):
+            for j in range(x0,x1):
+                for k in range(img.shape[2]):
+                    if img[i,j,k]!=0:
+                        return True
+                    
+        return False
+    
+    @njit(cache=True)
+    def _zeroMarginsJit(img,margin):
+        h,w=img.shape[:2]
+        top=min(margin,h)
+        left=min(margin,w)
+        
+        return not (_anyNonzero(img,0,top,0,w) or _anyNonzero(img,h-top,h,0,w) or 
+                    _anyNonzero(img,0,h,0,left) or _anyNonzero(img,0,h,w-left,w))
+    
+    @njit(cache=True)
+    def _minMaxJit(arr):
+        mina=arr[0]
+        maxa=arr[0]
+        
+        for v in arr:
+            if v!=v: # NaN propagates as np.min/np.max would
+                return v,v
+            elif v<mina:
+                mina=v
+            elif v>maxa:
+                maxa=v
+                
+        return mina,maxa
+    
+    # not parallel since batch generators already run this in concurrent threads or forked processes, which numba's
+    # threading layers don't support
+    @njit(cache=True)
+    def _flipRescaleBatchJit(arr,flipCodes,out):
+        b,h,w,c=arr.shape
+        
+        for n in range(b):
+            mina,maxa=_minMaxJit(arr[n].ravel())
+            scale=1.0/(maxa-mina) if maxa>mina else 0.0
+            
+            for i in range(h):
+                si=h-1-i if flipCodes[n]==2 else i
+                for j in range(w):
+                    sj=w-1-j if flipCodes[n]==1 else j
+                    for k in range(c):
+                        out[n,i,j,k]=(arr[n,si,sj,k]-mina)*scale
+    
+    # compile for the common types on import so that the first training batch doesn't pay for it
+    _zeroMarginsJit(np.zeros((1,1,1),np.int32),1)
+    _minMaxJit(np.zeros((1,),np.float32))
+
+
 def samePadding(kernelSize, dilation=1):
     '''
     Return the padding value needed to ensure a convolution using the given kernel size produces an output of the same
     shape as the input for a stride of 1, otherwise ensure a shape of the input divided by the stride rounded down.
     '''
+    # sequence arguments are converted to tuples so that they can be used as keys for the result cache
+    if not np.isscalar(kernelSize):
+        kernelSize = tuple(np.ravel(kernelSize).tolist())
+    if not np.isscalar(dilation):
+        dilation = tuple(np.ravel(dilation).tolist())
+        
+    return _samePadding(kernelSize, dilation)
+
+
+@lru_cache(maxsize=None)
+def _samePadding(kernelSize, dilation):
     kernelSize = np.atleast_1d(kernelSize)
-    padding = ((kernelSize - 1) // 2) + (dilation - 1)
+    padding = ((kernelSize - 1) // 2) + (np.asarray(dilation) - 1)
 
-    return tuple(padding) if padding.shape[0] > 1 else padding[0]
+    return tuple(int(p) for p in padding) if padding.shape[0] > 1 else int(padding[0])
 
 
 def calculateOutShape(inShape, kernelSize, stride, padding):
@@ -97,7 +250,7 @@ def calculateOutShape(inShape, kernelSize, stride, padding):
     inShape = np.atleast_1d(inShape)
     outShape = ((inShape - kernelSize + padding + padding) // stride) + 1
 
-    return tuple(outShape) if outShape.shape[0] > 1 else outShape[0]
+    return tuple(int(s) for s in outShape) if outShape.shape[0] > 1 else int(outShape[0])
 
 
 def applyArgMap(func,*posargs,**kwargs):
@@ -268,8 +421,7 @@ def rescaleArray(arr,minv=0.0,maxv=1.0,dtype=np.float32):
     if dtype is not None:
         arr=arr.astype(dtype)
         
-    mina=np.min(arr)
-    maxa=np.max(arr)
+    mina,maxa=minMax(arr)
     
     if mina==maxa:
         return arr*minv
@@ -280,11 +432,16 @@ def rescaleArray(arr,minv=0.0,maxv=1.0,dtype=np.float32):
 
 def rescaleInstanceArray(arr,minv=0.0,maxv=1.0,dtype=np.float32):
     '''Rescale each array slice along the first dimension of `arr' independently.'''
-    out=np.zeros(arr.shape,dtype)
-    for i in range(arr.shape[0]):
-        out[i]=rescaleArray(arr[i],minv,maxv,dtype)
+    if dtype is not None:
+        arr=arr.astype(dtype)
         
-    return out
+    axes=tuple(range(1,arr.ndim))
+    mina=np.min(arr,axes,keepdims=True)
+    maxa=np.max(arr,axes,keepdims=True)
+    diff=maxa-mina
+    
+    norm=(arr-mina)/np.where(diff==0,1,diff) # normalize every slice at once, avoiding division by 0 for flat slices
+    return np.where(diff==0,arr*minv,(norm*(maxv-minv))+minv)
 
 
 def rescaleArrayIntMax(arr,dtype=np.uint16):